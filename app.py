@@ -491,6 +491,12 @@ elif model_type == "Optimization":
                                 json=payload,
                                 timeout=60,
                             )
+                            if r.status_code == 503:
+                                # backend queue is full: tell the coach when to try again
+                                retry = r.headers.get("Retry-After", "60")
+                                st.warning(f"The optimiser is busy ({r.json().get('detail', 'queue full')}). "
+                                           f"Please try again in {retry} s.")
+                                st.stop()
                             r.raise_for_status()       
                         except requests.HTTPError as e:
                             st.error(f"HTTP {e.response.status_code}: {e.response.text}")  # ★
@@ -511,7 +517,17 @@ elif model_type == "Optimization":
                     resp = requests.get(f"http://35.209.48.32:8000/run_optimization/{job_id}", timeout=10)
                     data = resp.json()
 
-                    if data.get("state") == "running":
+                    if data.get("state") == "queued":
+                        # waiting behind other jobs on the backend
+                        progress.progress(0, text="Waiting in queue")
+                        status_box.info(
+                            f"Job `{job_id}` is queued: position {data.get('position')} "
+                            f"of {data.get('queue_length')}…"
+                        )
+                        time.sleep(5)
+                        st.rerun()
+
+                    elif data.get("state") == "running":
                         pct = data.get("progress", 0)
                         progress.progress(pct, text=f"{pct}% complete")
                         status_box.info(f"Job `{job_id}` is running…")
@@ -551,6 +567,16 @@ elif model_type == "Optimization":
                                 f"• Switch schedule: `{switches}`"
                             )
 
+                    elif data.get("state") in ("cancelling", "cancelled"):
+                        # stopped through DELETE /run_optimization/{job_id}
+                        if data["state"] == "cancelling":
+                            status_box.info(f"Job `{job_id}` is being cancelled…")
+                            time.sleep(2)
+                            st.rerun()
+                        st.session_state.opt_polling = False
+                        progress.empty()
+                        st.warning(f"Job `{job_id}` was cancelled.")
+
                     elif data.get("state") == "error":
                         st.session_state.opt_polling = False
                         progress.empty()
@@ -8,8 +8,11 @@ import math
 import random
 from scipy.optimize import root_scalar
 from scipy.stats import truncnorm
+from scipy.special import ndtr, ndtri
 import itertools
+import functools
 from itertools import permutations, combinations
+from collections import OrderedDict
 import traceback, logging
 logger = logging.getLogger(__name__)
 
@@ -44,7 +47,16 @@ def get_rider_info(num, df, number_to_name):
 
     return W_prime, CP, AC, Pmax, m_rider
 
-def simulate_accel_phase_with_thalf(s, P_const, num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, Crr=0.0018, rho=1.225, dt=0.05):
+# integrator='euler' is the original fixed-step model. integrator='rk4' uses simulate_accel_phase_rk4 below: RK4 steps
+# of rk_step seconds with the exact times the rider crosses 187.5 m and the end of the acceleration.
+# integrator='analytic' steps the ramp as usual and uses constant_power_segment for the constant-power phase.
+def simulate_accel_phase_with_thalf(s, P_const, num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, Crr=0.0018, rho=1.225, dt=0.05, integrator='euler', rk_step=0.5):
+    if integrator == 'rk4':
+        return simulate_accel_phase_rk4(s, P_const, num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, rho, dt, rk_step)
+    if integrator == 'analytic':
+        batch = simulate_accel_phase_batch([s], [P_const], num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, rho, dt, record=True, integrator='analytic')
+        t_total, v_total = batch_trajectory(batch, 0)
+        return batch['tfin'][0], batch['Wprime_used'][0], batch['v_final'][0], batch['t_half'][0], t_total, v_total
     track_half_lap = 125
     M = m_rider + m_wheels
     drag_coeff = 0.5 * rho * CdA
@@ -104,33 +116,384 @@ def simulate_accel_phase_with_thalf(s, P_const, num_of_half_laps, m_rider, m_whe
     return t_fin, Wprime_used, v_final, t_half, t_total, v_total
 
 
+# Classic RK4 on (x, v) with step h instead of forward Euler with dt. The ramp ends and the acceleration finishes at
+# the exact times x reaches ramp_half_laps and num_of_half_laps half laps: the crossing inside the last step is found
+# on the cubic Hermite interpolant of x(t) (x' = v is known at both ends) rather than taking the first sample past
+# it. The returned t_total / v_total are resampled every dt (plus t_half and t_fin themselves) from the Hermite
+# interpolant of v(t), so they drop into accel_phase and the plots like the Euler output. W' is integrated exactly,
+# since power is piecewise linear in t. Same return values as simulate_accel_phase_with_thalf.
+def simulate_accel_phase_rk4(s, P_const, num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, rho=1.225, dt=0.05, h=0.5, ramp_half_laps=1.5):
+    track_half_lap = 125
+    M = m_rider + m_wheels
+    drag_coeff = 0.5 * rho * CdA
+
+    def accel(P, v):
+        return (P - drag_coeff * v**3) / (M * v) if v > 0 else 0.0
+
+    # nodes of the whole run: time, distance from the start, velocity, acceleration
+    ts, xs, vs, accs = [0.0], [0.0], [v0], [accel(P_init, v0)]
+
+    def run_until(x_stop, power, t, x, v):
+        a_left = accel(power(t), v)
+        while x < x_stop:
+            if len(ts) > 1000000:
+                raise ValueError("Acceleration phase did not finish.")
+            k1v = accel(power(t), v)
+            k2v = accel(power(t + h / 2), v + h / 2 * k1v)
+            k3v = accel(power(t + h / 2), v + h / 2 * k2v)
+            k4v = accel(power(t + h), v + h * k3v)
+            x_new = x + h / 6 * (v + 2 * (v + h / 2 * k1v) + 2 * (v + h / 2 * k2v) + (v + h * k3v))
+            v_new = v + h / 6 * (k1v + 2 * k2v + 2 * k3v + k4v)
+            if x_new >= x_stop:
+                # event: solve the Hermite cubic x(t_cross) = x_stop on [t, t + h] by Newton from the linear guess
+                a_new = accel(power(t + h), v_new)
+                tau = (x_stop - x) / (x_new - x)
+                for _ in range(4):
+                    x_tau, v_tau = _hermite(tau, h, x, x_new, v, v_new)
+                    tau = min(max(tau - (x_tau - x_stop) / (h * v_tau), 0.0), 1.0)
+                v_cross = _hermite(tau, h, v, v_new, a_left, a_new)[0]
+                t, x, v = t + tau * h, x_stop, v_cross
+            else:
+                t, x, v = t + h, x_new, v_new
+            a_left = accel(power(t), v)
+            ts.append(t)
+            xs.append(x)
+            vs.append(v)
+            accs.append(a_left)
+        return t, x, v
+
+    ramp_dist = track_half_lap * ramp_half_laps
+    total_dist = track_half_lap * max(num_of_half_laps, ramp_half_laps)
+    t_half, x, v_half = run_until(ramp_dist, lambda t: P_init + s * t, 0.0, 0.0, v0)
+    n_ramp = len(ts)
+    # the node at t_half carries the ramp's acceleration; the constant-power phase starts from P_const
+    t_fin, _, v_final = run_until(total_dist, lambda t: P_const, t_half, x, v_half)
+
+    ts = np.array(ts)
+    vs = np.array(vs)
+    accs = np.array(accs)
+    if len(ts) > n_ramp:
+        accs[n_ramp - 1] = accel(P_const, v_half)   # right-hand derivative for the constant-power intervals
+
+    # resample every dt, keeping t_half and t_fin as samples
+    t_ramp = np.arange(0.0, t_half, dt)
+    t_const = t_half + np.arange(dt, t_fin - t_half, dt)
+    t_total = np.concatenate([t_ramp, [t_half], t_const, [t_fin]]) if t_fin > t_half else np.concatenate([t_ramp, [t_half]])
+    idx = np.clip(np.searchsorted(ts, t_total, side='right') - 1, 0, len(ts) - 2)
+    # samples at or before t_half must use ramp intervals
+    ramp_mask = t_total <= t_half
+    idx[ramp_mask] = np.minimum(idx[ramp_mask], n_ramp - 2)
+    step = ts[idx + 1] - ts[idx]
+    tau = np.where(step > 0, (t_total - ts[idx]) / np.where(step > 0, step, 1.0), 0.0)
+    left_acc = accs[idx]
+    right_acc = np.where(idx + 1 == n_ramp - 1, accel(P_init + s * t_half, v_half), accs[idx + 1])
+    v_total = _hermite(tau, step, vs[idx], vs[idx + 1], left_acc, right_acc)[0]
+
+    # W': power is P_init + s * t on the ramp (above CP on [t_a, t_b]) and P_const after it
+    if s > 0:
+        t_a, t_b = min(max((CP - P_init) / s, 0.0), t_half), t_half
+    elif s < 0:
+        t_a, t_b = 0.0, min(max((CP - P_init) / s, 0.0), t_half)
+    else:
+        t_a, t_b = 0.0, (t_half if P_init > CP else 0.0)
+    Wprime_used = (P_init - CP) * (t_b - t_a) + 0.5 * s * (t_b**2 - t_a**2)
+    Wprime_used += max(P_const - CP, 0.0) * (t_fin - t_half)
+
+    return t_fin, Wprime_used, v_final, t_half, t_total, v_total
+
+# cubic Hermite interpolation on a step of length h at fraction tau, from end values y0, y1 and derivatives d0, d1;
+# returns the value and its time derivative
+def _hermite(tau, h, y0, y1, d0, d1):
+    tau2 = tau * tau
+    tau3 = tau2 * tau
+    value = (2 * tau3 - 3 * tau2 + 1) * y0 + (tau3 - 2 * tau2 + tau) * h * d0 + (-2 * tau3 + 3 * tau2) * y1 + (tau3 - tau2) * h * d1
+    slope = ((6 * tau2 - 6 * tau) * y0 + (3 * tau2 - 4 * tau + 1) * h * d0 + (-6 * tau2 + 6 * tau) * y1 + (3 * tau2 - 2 * tau) * h * d1) / np.where(np.asarray(h) > 0, h, 1.0)
+    return value, slope
+
+# Batched version of simulate_accel_phase_with_thalf. s and P_const are broadcast against each other and every
+# (s, P_const) pair is one lane; all lanes take the same Euler steps as the scalar version, one NumPy pass per dt.
+# The ramp (phase 1) does not depend on P_const, so it is only integrated once per distinct slope; the
+# constant-power phase is then integrated for all lanes together, and a lane drops out of the working set as soon
+# as it has covered the acceleration distance (the "finished" mask). W' uses the same trapezoid rule as the scalar
+# version, so results match it to floating point noise.
+# With record=True the constant-power velocities are kept in a preallocated buffer (grown if a lane runs long); use
+# batch_trajectory(result, i) to get lane i's (t_total, v_total) exactly as the scalar version returns them.
+# integrator='analytic' keeps the stepped ramp but replaces the constant-power phase by its closed form.
+# build_accel_table runs it once over a leader's whole (slope x P) grid; the lookup tables and inverse curves behind
+# accel_phase_curve and black_box_batch come from that one call.
+def simulate_accel_phase_batch(s, P_const, num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, rho=1.225, dt=0.05, record=False, max_steps=100000, integrator='euler'):
+    track_half_lap = 125
+    M = m_rider + m_wheels
+    drag_coeff = 0.5 * rho * CdA
+    ramp_dist = track_half_lap * 3 / 2
+    remaining_dist = (num_of_half_laps - 1.5) * track_half_lap
+
+    s, P_const = np.broadcast_arrays(np.asarray(s, dtype=float), np.asarray(P_const, dtype=float))
+    s = s.ravel().copy()
+    P_const = P_const.ravel().copy()
+    n = s.size
+    slopes, slope_idx = np.unique(s, return_inverse=True)
+
+    # --- Phase 1: increasing power, once per distinct slope ---
+    # only a handful of slopes are ever swept, so this stays a plain loop (faster than NumPy on 3 lanes)
+    ns = slopes.size
+    W_ramp = np.zeros(ns)
+    P_int_ramp = np.zeros(ns)
+    v3_int_ramp = np.zeros(ns)
+    t_half = np.zeros(ns)
+    v_half = np.zeros(ns)
+    ramp_steps = np.zeros(ns, dtype=int)
+    ramp_trajectories = []
+    for k, slope in enumerate(slopes):
+        x = 0
+        t = 0
+        v = v0
+        W = 0.0
+        P_int = 0.0
+        v3_int = 0.0
+        over_prev = max(P_init - CP, 0.0)
+        v_vals = [v0]
+        while x < ramp_dist:
+            if len(v_vals) > max_steps:
+                raise ValueError(f"Acceleration phase did not finish within {max_steps} steps.")
+            P = P_init + slope * t
+            v3_prev = v**3
+            a = (P - drag_coeff * v3_prev) / (M * v) if v > 0 else 0.0
+            v += a * dt
+            x += v * dt
+            P_new = P_init + slope * (t + dt)
+            over_new = max(P_new - CP, 0.0)
+            W += 0.5 * (over_prev + over_new) * ((t + dt) - t)
+            P_int += 0.5 * (P + P_new) * ((t + dt) - t)
+            v3_int += 0.5 * (v3_prev + v**3) * ((t + dt) - t)
+            over_prev = over_new
+            t += dt
+            v_vals.append(v)
+        W_ramp[k] = W
+        P_int_ramp[k] = P_int
+        v3_int_ramp[k] = v3_int
+        t_half[k] = t
+        v_half[k] = v
+        ramp_steps[k] = len(v_vals) - 1
+        ramp_trajectories.append(v_vals)
+
+    # --- Phase 2: constant power, every lane ---
+    t_half_lane = t_half[slope_idx]
+    if integrator == 'analytic':
+        # closed form, no stepping (see constant_power_segment); the phase ends exactly at remaining_dist
+        duration, v_final, v3_int_const = constant_power_segment(P_const, v_half[slope_idx], max(remaining_dist, 0.0), M, drag_coeff)
+        t_fin = t_half_lane + duration
+        const_steps = np.ceil(duration / dt - 1e-9).astype(int)
+        first = np.zeros(n)
+        if record:
+            # samples every dt after t_half and the exact end point, by inverting t(v)
+            const_buffer = np.zeros((n, const_steps.max() + 1))
+            const_buffer[:, 0] = v_half[slope_idx]
+            for i in range(n):
+                tau = dt * np.arange(1, const_steps[i])
+                const_buffer[i, 1:const_steps[i]] = constant_power_velocity(tau, P_const[i], v_half[slope_idx[i]], v_final[i], M, drag_coeff)
+                const_buffer[i, const_steps[i]] = v_final[i]
+    else:
+        # Euler, compacted as lanes finish
+        v_final = np.zeros(n)
+        v3_int_const = np.zeros(n)
+        const_steps = np.zeros(n, dtype=int)
+
+        lane = np.arange(n)
+        P_run = P_const
+        v = v_half[slope_idx]
+        x = np.zeros(n)
+        v3_int = np.zeros(n)
+        if record:
+            const_buffer = np.zeros((n, int(2 * max(remaining_dist, 0) / (max(v0, 1.0) * dt)) + 2))
+            const_buffer[:, 0] = v
+
+        step = 0
+        if remaining_dist <= 0:
+            lane = lane[:0]
+        while lane.size:
+            if step >= max_steps:
+                raise ValueError(f"Acceleration phase did not finish within {max_steps} steps.")
+            v3_prev = v**3
+            if v.min() > 0:
+                v = v + (P_run - drag_coeff * v3_prev) / (M * v) * dt
+            else:
+                v = v + np.where(v > 0, (P_run - drag_coeff * v3_prev) / (M * np.where(v > 0, v, 1.0)), 0.0) * dt
+            x += v * dt
+            v3_int += 0.5 * (v3_prev + v**3) * dt
+            step += 1
+            if record:
+                if step >= const_buffer.shape[1]:
+                    const_buffer = np.concatenate([const_buffer, np.zeros_like(const_buffer)], axis=1)
+                const_buffer[lane, step] = v
+            done = x >= remaining_dist
+            if done.any():
+                finished = lane[done]
+                v_final[finished] = v[done]
+                v3_int_const[finished] = v3_int[done]
+                const_steps[finished] = step
+                keep = ~done
+                lane, P_run, v, x, v3_int = lane[keep], P_run[keep], v[keep], x[keep], v3_int[keep]
+        if remaining_dist <= 0:
+            v_final = v_half[slope_idx].copy()
+
+        # t accumulates from t_half by dt each step, as in the scalar loop
+        t_fin = t_half_lane + const_steps * dt
+        first = np.minimum(const_steps, 1) * dt
+
+    # W': ramp part, the trapezoid from the last ramp sample (P_init + s * t_half) to the first constant-power
+    # sample (Euler only), then a constant integrand for the rest of the phase
+    over_half = np.maximum(P_init + s * t_half_lane - CP, 0.0)
+    over_const = np.maximum(P_const - CP, 0.0)
+    Wprime_used = W_ramp[slope_idx] + 0.5 * (over_half + over_const) * first + over_const * (t_fin - t_half_lane - first)
+
+    # leader power and v^3 integrated over the whole phase, which is all accel_phase needs for the followers
+    P_half = P_init + s * t_half_lane
+    P_integral = P_int_ramp[slope_idx] + 0.5 * (P_half + P_const) * first + P_const * (t_fin - t_half_lane - first)
+    v3_integral = v3_int_ramp[slope_idx] + v3_int_const
+
+    result = {
+        's': s,
+        'P_const': P_const,
+        'tfin': t_fin,
+        'Wprime_used': Wprime_used,
+        'v_final': v_final,
+        't_half': t_half_lane,
+        'P_integral': P_integral,
+        'v3_integral': v3_integral,
+        'n_steps': ramp_steps[slope_idx] + const_steps,
+    }
+    if record:
+        result['slope_idx'] = slope_idx
+        result['ramp_steps'] = ramp_steps
+        result['const_steps'] = const_steps
+        result['ramp_trajectories'] = ramp_trajectories
+        result['const_buffer'] = const_buffer
+        result['dt'] = dt
+    return result
+
+# Closed form of the constant-power stretch, M v dv/dt = P - k v^3 with k = 0.5 * rho * CdA. With the terminal
+# velocity a = (P / k)^(1/3):
+#   distance  x(v) = M / (3k) * ln((P - k v0^3) / (P - k v^3))  ->  v(x) = ((P - (P - k v0^3) exp(-3 k x / M)) / k)^(1/3)
+#   time      t(v) = M / k * (F(v) - F(v0)),  F(v) = ln((v^2 + a v + a^2) / (a - v)^2) / (6a) - arctan((2v + a) / (a sqrt 3)) / (a sqrt 3)
+#   v^3       k * integral(v^3 dt) = P t - M (v^2 - v0^2) / 2   (energy balance)
+# Works elementwise on arrays; returns (duration, v_end, integral of v^3 dt) for covering `distance` metres.
+def constant_power_segment(P, v_start, distance, M, drag_coeff):
+    P = np.asarray(P, dtype=float)
+    v_start = np.asarray(v_start, dtype=float)
+    if np.any(P <= 0):
+        raise ValueError("Closed-form constant-power segment needs P > 0.")
+    k = drag_coeff
+    a = np.cbrt(P / k)
+    v_end = np.cbrt((P - (P - k * v_start**3) * np.exp(-3 * k * distance / M)) / k)
+
+    # starting at (numerically) the terminal velocity the rider just holds it
+    at_terminal = np.abs(v_start - a) <= 1e-9 * a
+    v_s = np.where(at_terminal, 0.5 * a, v_start)
+    v_e = np.where(at_terminal, 0.25 * a, v_end)
+    duration = M / k * (_constant_power_F(v_e, a) - _constant_power_F(v_s, a))
+    duration = np.where(at_terminal, distance / a, duration)
+    v_end = np.where(at_terminal, a, v_end)
+
+    v3_integral = (P * duration - M * (v_end**2 - v_start**2) / 2) / k
+    return duration, v_end, v3_integral
+
+def _constant_power_F(v, a):
+    return np.log((v * v + a * v + a * a) / (a - v)**2) / (6 * a) - np.arctan((2 * v + a) / (a * np.sqrt(3))) / (a * np.sqrt(3))
+
+# velocity tau seconds into a constant-power stretch that runs from v_start to v_end: Newton on t(v) = tau,
+# kept between v_start and v_end
+def constant_power_velocity(tau, P, v_start, v_end, M, drag_coeff):
+    k = drag_coeff
+    a = np.cbrt(P / k)
+    tau = np.asarray(tau, dtype=float)
+    if abs(v_end - v_start) < 1e-12:
+        return np.full(tau.shape, v_end)
+    lo, hi = min(v_start, v_end), max(v_start, v_end)
+    F0 = _constant_power_F(v_start, a)
+    total = M / k * (_constant_power_F(v_end, a) - F0)
+    v = v_start + (v_end - v_start) * np.clip(tau / total, 0.0, 1.0)
+    for _ in range(8):
+        g = M / k * (_constant_power_F(v, a) - F0) - tau
+        v = np.clip(v - g * (P - k * v**3) / (M * v), lo, hi)
+    return v
+
+# Rebuild lane i's (t_total, v_total) from a simulate_accel_phase_batch(..., record=True) result
+def batch_trajectory(batch, i):
+    k = batch['slope_idx'][i]
+    n1 = batch['ramp_steps'][k]
+    n2 = batch['const_steps'][i]
+    dt = batch['dt']
+    t_ramp = np.cumsum(np.concatenate([[0.0], np.full(n1, dt)]))
+    t_const = batch['t_half'][i] + dt * np.arange(1, n2 + 1)
+    if n2:
+        t_const[-1] = batch['tfin'][i]
+    t_total = np.concatenate([t_ramp, t_const])
+    v_total = np.concatenate([batch['ramp_trajectories'][k], batch['const_buffer'][i, 1:n2 + 1]])
+    return t_total, v_total
+
+
 # Updated optimizer to return t_half
-def find_best_power_profile(s_range, P_bounds, num_of_half_laps, v_target, m_rider, m_wheels, P_init, v0, CdA, CP, epsilon=0.4, rho=1.225):
+# method='bisect' is the original bisection over P for every slope. method='brentq' gets to the same tolerance in
+# far fewer integrations: Brent's method (secant / inverse quadratic steps inside a bracket), warm-started from a
+# bracket predicted from the previous slope's root, with every trajectory kept so the root and the bracket ends
+# are never re-simulated. Both modes report the number of integrations in the result ('n_integrations').
+# POWER_PROFILE_METHOD is the default, so accel_phase and the full combined model (black_box, full_black_box_batch)
+# use brentq: ~13 integrations a query instead of ~33, and a full-model race takes ~0.09 s instead of ~0.21 s with
+# the same race time.
+POWER_PROFILE_METHOD = 'brentq'
+
+def find_best_power_profile(s_range, P_bounds, num_of_half_laps, v_target, m_rider, m_wheels, P_init, v0, CdA, CP, epsilon=0.4, rho=1.225, method=None, integrator='euler'):
+    method = POWER_PROFILE_METHOD if method is None else method
     # start_time2 = time.time()
     best_result = None
     min_Wprime = float('inf')
+    n_integrations = 0
+    prev_root = None
+    dv_dP = None
 
     for s in s_range:
         cached_result = {}
+        trajectories = {}
+
+        def simulate(P):
+            nonlocal n_integrations
+            if P not in trajectories:
+                n_integrations += 1
+                try:
+                    trajectories[P] = simulate_accel_phase_with_thalf(s, P, num_of_half_laps,  m_rider, m_wheels, P_init, v0, CdA, CP, rho, integrator=integrator)
+                except Exception:
+                    trajectories[P] = None
+            return trajectories[P]
 
         def v_error(P):
-            try:
-                result = simulate_accel_phase_with_thalf(s, P, num_of_half_laps,  m_rider, m_wheels, P_init, v0, CdA, CP, rho)
-                cached_result["result"] = result  # store it to avoid recomputation
-                _, _, v_final, _, _, _ = result
-                # print(f"s={s:.1f}, P={P:.1f}, v_final={v_final:.2f}, target={v_target:.2f}")
-                return v_final - v_target
-            except Exception:
-                cached_result["result"] = None
+            result = simulate(P)
+            cached_result["result"] = result  # store it to avoid recomputation
+            if result is None:
                 return np.inf
-
-        try:
-            root = root_scalar(v_error, bracket=P_bounds, method='bisect', xtol=1e-3, rtol=1e-3)
-        except ValueError:
-            continue
+            _, _, v_final, _, _, _ = result
+            # print(f"s={s:.1f}, P={P:.1f}, v_final={v_final:.2f}, target={v_target:.2f}")
+            return v_final - v_target
+
+        if method == 'brentq':
+            bracket = _warm_bracket(v_error, P_bounds, prev_root, dv_dP)
+            if bracket is None:
+                continue
+            try:
+                root = root_scalar(v_error, bracket=bracket, method='brentq', xtol=1e-3, rtol=1e-3)
+            except ValueError:
+                continue
+            cached_result["result"] = simulate(root.root)
+            dv_dP = _local_slope(trajectories, root.root, v_target) or dv_dP
+        else:
+            try:
+                root = root_scalar(v_error, bracket=P_bounds, method='bisect', xtol=1e-3, rtol=1e-3)
+            except ValueError:
+                continue
 
         if not root.converged or cached_result["result"] is None:
             continue
+        prev_root = root.root
 
         # Use cached result instead of re-simulating
         tfin, Wprime_used, v_final, t_half, t_total, v_total = cached_result["result"]
@@ -150,9 +513,199 @@ def find_best_power_profile(s_range, P_bounds, num_of_half_laps, v_target, m_rid
 
     # end_time2 = time.time()
     # print(f"Optimization time: {end_time2 - start_time2:} seconds")
+    logger.debug("find_best_power_profile(%s): v_target=%.3f, %d integrations", method, v_target, n_integrations)
+    if best_result is not None:
+        best_result['n_integrations'] = n_integrations
+    return best_result
+
+# Bracket for the brentq mode. From the previous slope's root, one secant step (using that slope's dv/dP) predicts
+# where this slope's root is; the bracket is [previous root, prediction pushed 10% further]. If that does not
+# change sign, fall back to the part of P_bounds on the side the root must be on. None if there is no sign change
+# at all (the case where bisection raises ValueError).
+def _warm_bracket(v_error, P_bounds, prev_root, dv_dP):
+    lo, hi = P_bounds
+    if prev_root is not None and dv_dP:
+        e0 = v_error(prev_root)
+        if e0 == 0:
+            return prev_root, prev_root
+        guess = min(max(prev_root - 1.1 * e0 / dv_dP, lo), hi)
+        if guess != prev_root and e0 * v_error(guess) <= 0:
+            return min(prev_root, guess), max(prev_root, guess)
+        if e0 < 0:
+            edge = max(prev_root, guess)
+            return (edge, hi) if v_error(hi) >= 0 else None
+        edge = min(prev_root, guess)
+        return (lo, edge) if v_error(lo) <= 0 else None
+    if v_error(lo) * v_error(hi) > 0:
+        return None
+    return lo, hi
+
+# local dv_final/dP from the two evaluated powers closest to the root
+def _local_slope(trajectories, root, v_target):
+    points = sorted((P for P, r in trajectories.items() if r is not None), key=lambda P: abs(P - root))
+    for other in points[1:]:
+        if other != points[0]:
+            return (trajectories[points[0]][2] - trajectories[other][2]) / (points[0] - other)
+    return None
+
+# %%
+# Acceleration lookup tables. For a given leader (mass, CdA, CP), P0, v0 and acceleration length the map
+# (slope, P_const) -> (t_fin, W' used, v_final, ...) never changes, so it is built once on a (slope x P) grid and
+# every later query is answered by interpolation along P. Tables are kept per process in _accel_tables, so all
+# the simulate_one tasks a worker runs for the same leader share one table. ACCEL_TABLE_INTEGRATOR picks how the
+# constant-power phase is evaluated when a table is built ('analytic' is several times faster to build).
+_accel_tables = {}
+ACCEL_TABLE_CACHE_SIZE = 64
+ACCEL_TABLE_INTEGRATOR = 'euler'
+
+def build_accel_table(s_range, P_bounds, num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, rho=1.225, num_P=256, dt=0.05, integrator='euler'):
+    s_range = np.asarray(s_range, dtype=float)
+    P_grid = np.linspace(P_bounds[0], P_bounds[1], num_P)
+    batch = simulate_accel_phase_batch(s_range[:, None], P_grid[None, :], num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, rho, dt, integrator=integrator)
+    table = {'s_range': s_range, 'P_grid': P_grid}
+    for key in ('tfin', 'Wprime_used', 'v_final', 't_half', 'P_integral', 'v3_integral'):
+        table[key] = batch[key].reshape(len(s_range), num_P)
+    return table
+
+def _accel_table_key(s_range, P_bounds, num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, rho, num_P, dt):
+    return (tuple(float(s) for s in s_range), float(P_bounds[0]), float(P_bounds[1]), num_of_half_laps,
+            float(m_rider), float(m_wheels), float(P_init), float(v0), float(CdA), float(CP), float(rho), num_P, dt)
+
+def get_accel_table(s_range, P_bounds, num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, rho=1.225, num_P=256, dt=0.05, integrator=None):
+    integrator = ACCEL_TABLE_INTEGRATOR if integrator is None else integrator
+    key = _accel_table_key(s_range, P_bounds, num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, rho, num_P, dt) + (integrator,)
+    table = _accel_tables.get(key)
+    if table is None:
+        if len(_accel_tables) >= ACCEL_TABLE_CACHE_SIZE:
+            _accel_tables.clear()
+        table = build_accel_table(s_range, P_bounds, num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, rho, num_P, dt, integrator)
+        _accel_tables[key] = table
+    return table
+
+# Drop-in for find_best_power_profile that reads the rider's lookup table instead of integrating. The result has
+# no trajectory ('t_array' / 'v_array' are None); it carries 'P_integral' and 'v3_integral' instead, which is what
+# accel_phase uses to work out the followers' energy.
+def find_best_power_profile_table(s_range, P_bounds, num_of_half_laps, v_target, m_rider, m_wheels, P_init, v0, CdA, CP, epsilon=0.4, rho=1.225, num_P=256, dt=0.05):
+    table = get_accel_table(s_range, P_bounds, num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, rho, num_P, dt)
+    P_grid = table['P_grid']
+
+    best_result = None
+    min_Wprime = float('inf')
+    for i, s in enumerate(table['s_range']):
+        # v_final rises with P; the running max irons out the one-step jitter from the distance check
+        v_row = np.maximum.accumulate(table['v_final'][i])
+        if not v_row[0] <= v_target <= v_row[-1]:
+            continue
+        j = min(max(int(np.searchsorted(v_row, v_target)), 1), len(P_grid) - 1)
+        frac = 0.0 if v_row[j] == v_row[j - 1] else (v_target - v_row[j - 1]) / (v_row[j] - v_row[j - 1])
+
+        def lerp(name):
+            return table[name][i, j - 1] + frac * (table[name][i, j] - table[name][i, j - 1])
+
+        Wprime_used = lerp('Wprime_used')
+        if Wprime_used < min_Wprime:
+            best_result = {
+                's': s,
+                'P_const': P_grid[j - 1] + frac * (P_grid[j] - P_grid[j - 1]),
+                'tfin': lerp('tfin'),
+                'Wprime_used': Wprime_used,
+                'v_final': v_target,
+                't_half': table['t_half'][i, j],
+                'P_integral': lerp('P_integral'),
+                'v3_integral': lerp('v3_integral'),
+                't_array': None,
+                'v_array': None
+            }
+            min_Wprime = Wprime_used
     return best_result
 
-def accel_phase(v0, P0, Pmax, v_target, start_order, drafting_percents, df, acc_half_laps, bank_angle, rider_data, W_rem_start, rho=1.225, m_wheels=0.75, g = 9.81):
+
+# %%
+# Inverse acceleration map. accel_phase only ever asks "what is the cheapest profile that reaches v_target?", so
+# for each leader and acceleration length the table above is turned into a curve over a sorted grid of target
+# velocities: for every v_target, the slope with the least W' and the P_const, t_fin, W' used, ... it needs. A
+# query is then a binary search on that grid plus a linear interpolation, with no integration at all.
+_accel_inverse_curves = {}
+
+def build_accel_inverse(table, v_step=0.01):
+    v_rows = np.maximum.accumulate(table['v_final'], axis=1)
+    v_lo = v_rows[:, 0].min()
+    v_hi = v_rows[:, -1].max()
+    v_grid = np.arange(v_lo, v_hi + v_step, v_step)
+    v_grid = v_grid[v_grid <= v_hi]
+
+    names = ('P_const', 'tfin', 'Wprime_used', 't_half', 'P_integral', 'v3_integral')
+    per_slope = {name: np.empty((len(table['s_range']), len(v_grid))) for name in names}
+    for i in range(len(table['s_range'])):
+        # v_rows is non-decreasing, which is all np.interp needs
+        per_slope['P_const'][i] = np.interp(v_grid, v_rows[i], table['P_grid'])
+        for name in names[1:]:
+            per_slope[name][i] = np.interp(v_grid, v_rows[i], table[name][i])
+        # a slope that cannot reach (or cannot stay below) v_target is not a candidate there
+        out_of_range = (v_grid < v_rows[i, 0]) | (v_grid > v_rows[i, -1])
+        per_slope['Wprime_used'][i, out_of_range] = np.inf
+
+    best = np.argmin(per_slope['Wprime_used'], axis=0)
+    cols = np.arange(len(v_grid))
+    curve = {'v_grid': v_grid, 's': table['s_range'][best]}
+    for name in names:
+        curve[name] = per_slope[name][best, cols]
+    return curve
+
+def get_accel_inverse(s_range, P_bounds, num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, rho=1.225, num_P=256, dt=0.05, v_step=0.01, integrator=None):
+    integrator = ACCEL_TABLE_INTEGRATOR if integrator is None else integrator
+    key = _accel_table_key(s_range, P_bounds, num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, rho, num_P, dt) + (integrator, v_step)
+    curve = _accel_inverse_curves.get(key)
+    if curve is None:
+        if len(_accel_inverse_curves) >= ACCEL_TABLE_CACHE_SIZE:
+            _accel_inverse_curves.clear()
+        table = get_accel_table(s_range, P_bounds, num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, rho, num_P, dt, integrator)
+        curve = build_accel_inverse(table, v_step)
+        _accel_inverse_curves[key] = curve
+    return curve
+
+# O(log n) drop-in for find_best_power_profile: binary search on the leader's inverse curve. Like the table
+# version it returns the integrals accel_phase needs instead of a trajectory.
+def find_best_power_profile_inverse(s_range, P_bounds, num_of_half_laps, v_target, m_rider, m_wheels, P_init, v0, CdA, CP, epsilon=0.4, rho=1.225, num_P=256, dt=0.05, v_step=0.01):
+    curve = get_accel_inverse(s_range, P_bounds, num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, rho, num_P, dt, v_step)
+    v_grid = curve['v_grid']
+    if not v_grid[0] <= v_target <= v_grid[-1]:
+        return None
+    j = min(max(int(np.searchsorted(v_grid, v_target)), 1), len(v_grid) - 1)
+    frac = (v_target - v_grid[j - 1]) / (v_grid[j] - v_grid[j - 1])
+
+    def lerp(name):
+        return curve[name][j - 1] + frac * (curve[name][j] - curve[name][j - 1])
+
+    return {
+        's': curve['s'][j if frac >= 0.5 else j - 1],
+        'P_const': lerp('P_const'),
+        'tfin': lerp('tfin'),
+        'Wprime_used': lerp('Wprime_used'),
+        'v_final': v_target,
+        't_half': lerp('t_half'),
+        'P_integral': lerp('P_integral'),
+        'v3_integral': lerp('v3_integral'),
+        't_array': None,
+        'v_array': None
+    }
+
+# power profile for other riders: (m_i / m_leader) * P - 0.5 * rho * v^3 * (AC_m_leader - drafting * AC_m_i),
+# integrated term by term, minus CP * t and the banking term. Works on arrays of integrals as well as scalars.
+def follower_energy(P_integral, v3_integral, t_end, start_order, drafting_percents, rider_data, bank_angle, rho=1.225, g=9.81):
+    leader = start_order[0]
+    m_leader = rider_data[leader]["m_rider"]
+    AC_m_leader = rider_data[leader]["AC"] / m_leader
+    energies = []
+    for pos in range(1, 4):
+        rider = start_order[pos]
+        m_i = rider_data[rider]["m_rider"]
+        AC_m_i = rider_data[rider]["AC"] / m_i
+        work = (m_i / m_leader) * P_integral - 0.5 * rho * v3_integral * (AC_m_leader - drafting_percents[pos] * AC_m_i)
+        energies.append(work - rider_data[rider]["CP"] * t_end - m_i * g * pos * np.sin(bank_angle))
+    return energies
+
+def accel_phase(v0, P0, Pmax, v_target, start_order, drafting_percents, df, acc_half_laps, bank_angle, rider_data, W_rem_start, rho=1.225, m_wheels=0.75, g = 9.81, profile_func=None):
     # rider_data = {}
     W_rem = W_rem_start.copy()
     
@@ -161,7 +714,9 @@ def accel_phase(v0, P0, Pmax, v_target, start_order, drafting_percents, df, acc_
     sweep_s = np.linspace(50, 90, 3)     # Sweep slopes from 
     P_bounds = (400, Pmax)                  # Reasonable range for constant power
 
-    best_power_profile = find_best_power_profile(sweep_s, P_bounds, acc_half_laps, v_target, rider_data[leader]["m_rider"], m_wheels, P0, v0, rider_data[leader]["AC"], rider_data[leader]["CP"], rho)
+    if profile_func is None:
+        profile_func = find_best_power_profile
+    best_power_profile = profile_func(sweep_s, P_bounds, acc_half_laps, v_target, rider_data[leader]["m_rider"], m_wheels, P0, v0, rider_data[leader]["AC"], rider_data[leader]["CP"], rho)
     if best_power_profile is None:
         raise ValueError(f"No feasible acceleration found for target velocity {v_target:.2f} m/s.")
     slope = best_power_profile['s']
@@ -170,48 +725,34 @@ def accel_phase(v0, P0, Pmax, v_target, start_order, drafting_percents, df, acc_
     wprime_dec1 = best_power_profile['Wprime_used']
     t_half = best_power_profile['t_half']
 
-    #what the velo profile looks like
-    t_sim = best_power_profile['t_array']
-    v_sim = best_power_profile['v_array']
-
-    # power function
-    P_model = P0 + slope * (t_sim)
-    P_model[t_sim > t_half] = P_const
-
-
-    # solve for the acceleration
-    _, unique_indices = np.unique(t_sim, return_index=True)
-    t_sim_clean = t_sim[np.sort(unique_indices)]
-    v_sim_clean = v_sim[np.sort(unique_indices)]
-    a_sim = np.gradient(v_sim_clean, t_sim_clean)
-    # a_sim = np.gradient(v_sim, t_sim)  # derivative dv/dt
-    P_model_clean = P_model[np.sort(unique_indices)]
-
-    # power profile for other riders
-    v3 = v_sim_clean ** 3
-
-    m_leader = rider_data[leader]["m_rider"]
-    AC_leader = rider_data[leader]["AC"]
-    AC_m_leader = AC_leader / m_leader
-
-    m2 = rider_data[start_order[1]]["m_rider"]
-    m3 = rider_data[start_order[2]]["m_rider"]
-    m4 = rider_data[start_order[3]]["m_rider"]
-
-    AC_m2 = rider_data[start_order[1]]["AC"] / m2
-    AC_m3 = rider_data[start_order[2]]["AC"] / m3
-    AC_m4 = rider_data[start_order[3]]["AC"] / m4
-
-    power2 = (m2 / m_leader) * P_model_clean - 0.5 * rho * v3 * (AC_m_leader - drafting_percents[1] * AC_m2)
-    power3 = (m3 / m_leader) * P_model_clean - 0.5 * rho * v3 * (AC_m_leader - drafting_percents[2] * AC_m3)
-    power4 = (m4 / m_leader) * P_model_clean - 0.5 * rho * v3 * (AC_m_leader - drafting_percents[3] * AC_m4)
-
-
-
-    # computing the energy for each rider
-    energy2 = np.trapezoid(power2, t_sim_clean) - rider_data[start_order[1]]["CP"]*(t_sim_clean[-1]) - rider_data[start_order[1]]["m_rider"]*g*np.sin(bank_angle)
-    energy3 = np.trapezoid(power3, t_sim_clean) - rider_data[start_order[2]]["CP"]*(t_sim_clean[-1]) - rider_data[start_order[2]]["m_rider"]*g*2*np.sin(bank_angle)
-    energy4 = np.trapezoid(power4, t_sim_clean) - rider_data[start_order[3]]["CP"]*(t_sim_clean[-1]) - rider_data[start_order[3]]["m_rider"]*g*3*np.sin(bank_angle)
+    if best_power_profile.get('t_array') is None:
+        # table lookups (find_best_power_profile_table) carry the integrals the followers need instead of a trajectory
+        t_sim_clean = v_sim_clean = a_sim = None
+        P_integral = best_power_profile['P_integral']
+        v3_integral = best_power_profile['v3_integral']
+        t_end = tfin
+    else:
+        #what the velo profile looks like
+        t_sim = best_power_profile['t_array']
+        v_sim = best_power_profile['v_array']
+
+        # power function
+        P_model = P0 + slope * (t_sim)
+        P_model[t_sim > t_half] = P_const
+
+        # solve for the acceleration
+        _, unique_indices = np.unique(t_sim, return_index=True)
+        t_sim_clean = t_sim[np.sort(unique_indices)]
+        v_sim_clean = v_sim[np.sort(unique_indices)]
+        a_sim = np.gradient(v_sim_clean, t_sim_clean)
+        # a_sim = np.gradient(v_sim, t_sim)  # derivative dv/dt
+        P_model_clean = P_model[np.sort(unique_indices)]
+
+        P_integral = np.trapezoid(P_model_clean, t_sim_clean)
+        v3_integral = np.trapezoid(v_sim_clean ** 3, t_sim_clean)
+        t_end = t_sim_clean[-1]
+
+    energy2, energy3, energy4 = follower_energy(P_integral, v3_integral, t_end, start_order, drafting_percents, rider_data, bank_angle, rho, g)
 
     # updating W' for all riders
     W_rem[leader] -= wprime_dec1
@@ -222,6 +763,24 @@ def accel_phase(v0, P0, Pmax, v_target, start_order, drafting_percents, df, acc_
     # return tfin, W_rem, t_sim, v_sim, slope, P_const, t_half, a_sim
     return tfin, W_rem, t_sim_clean, v_sim_clean, slope, P_const, t_half, a_sim
 
+# accel_phase for every target velocity on the leader's inverse curve at once: returns the curve's v_grid and, per
+# rider in start_order, the W' left after accelerating to each of those velocities.
+def accel_phase_curve(v0, P0, Pmax, start_order, drafting_percents, df, acc_half_laps, bank_angle, rider_data, W_rem_start, rho=1.225, m_wheels=0.75, g = 9.81,
+                      num_P=256, dt=0.05, v_step=0.01, integrator=None):
+    leader = start_order[0]
+    sweep_s = np.linspace(50, 90, 3)
+    P_bounds = (400, Pmax)
+    curve = get_accel_inverse(sweep_s, P_bounds, acc_half_laps, rider_data[leader]["m_rider"], m_wheels, P0, v0, rider_data[leader]["AC"], rider_data[leader]["CP"], rho,
+                              num_P, dt, v_step, integrator)
+
+    followers = follower_energy(curve['P_integral'], curve['v3_integral'], curve['tfin'], start_order, drafting_percents, rider_data, bank_angle, rho, g)
+    W_rem = np.empty((len(start_order), len(curve['v_grid'])))
+    W_rem[0] = W_rem_start[leader] - curve['Wprime_used']
+    for pos in range(1, 4):
+        W_rem[pos] = W_rem_start[start_order[pos]] - followers[pos - 1]
+    return {'v_grid': curve['v_grid'], 'W_rem': W_rem, 'tfin': curve['tfin'], 's': curve['s'],
+            'P_const': curve['P_const'], 't_half': curve['t_half']}
+
 # 1. Put switch schedule in easier format (i.e. how many laps each person leads).
 # Switch schedule is now 1x32 list of 1s and 0s. If there is a 1 at index i (starting at 0), that means we switch after i half laps. 
 # This is intended to account for switching at the beginning of the steady-state phase (i.e. after zero half-laps).
@@ -333,7 +892,7 @@ def phase_energy(vel, f_ss, rider_stats, drag_adv, order, end, rho = 1.225, Crr
             else:
                 last_lap = 0
             # energy[rider] += (drag_adv[pos] * 0.5 * rho * rider_stats[rider]["AC"] * vel ** 2 + (rider_stats[rider]["m_rider"] + m_sys) * g * Crr - rider_stats[rider]["CP"] / vel) * (f_ss[i] * 125 + quarter_lap + penalty + last_lap)
-            energy[rider] = max(0, energy[rider] + (drag_adv[pos] * 0.5 * rho * rider_stats[rider]["AC"] * vel ** 2 + (rider_stats[rider]["m_rider"] + m_sys) * g * Crr - rider_stats[rider]["CP"] / vel) * (f_ss[i] * 125 + quarter_lap + penalty + last_lap))
+            energy[rider] = np.maximum(0, energy[rider] + (drag_adv[pos] * 0.5 * rho * rider_stats[rider]["AC"] * vel ** 2 + (rider_stats[rider]["m_rider"] + m_sys) * g * Crr - rider_stats[rider]["CP"] / vel) * (f_ss[i] * 125 + quarter_lap + penalty + last_lap))
 
         order = order[1:] + order[:1]
         i += 1
@@ -357,6 +916,93 @@ def race_energy(vel, peel, switch_schedule, rider_stats, drag_adv, order = [1,2,
         return energy
     return phase_energy(vel, f_ss, rider_stats, drag_adv, order, True, rho, Crr, g, bike_length)[0]
 
+# %%
+# Compiled switch schedules. Every segment in phase_energy adds (A v^2 + B - C / v) * d to one rider, so a
+# schedule is fully described by per-rider (A d, B d, C d) rows. The running max(0, ...) clamp is a Lindley
+# recursion: the energy after the last segment is max(0, largest suffix sum of the segment energies), and each
+# suffix sum is again a v^2 / constant / 1/v combination. compile_schedule stores those suffix coefficients per
+# rider, one block for the whole race or one block on either side of the peel (each clamped on its own, as in
+# race_energy), so the energy at any velocity or array of velocities is a small matrix product and a max.
+_compiled_schedules = {}
+SCHEDULE_CACHE_SIZE = 4096
+
+def _phase_coefficients(f_ss, rider_stats, drag_adv, order, end, rho = 1.225, Crr = 0.0018, g = 9.80665, bike_length = 2.1, m_sys = 10.0):
+    # same walk as phase_energy, collecting the distance-weighted coefficients of each segment instead of energies
+    segments = {rider: [] for rider in order}
+    num_riders = len(order)
+    num_changes = len(f_ss)
+    for i in range(num_changes):
+        penalty = 0 if i == 0 else bike_length
+        for pos, rider in enumerate(order):
+            if pos == 0 and i < num_changes - 1:
+                quarter_lap = 250 / 4
+            elif pos == num_riders - 1 and i > 0:
+                quarter_lap = -250 / 4
+            else:
+                quarter_lap = 0
+            last_lap = -250 / 4 if end and i == num_changes - 1 else 0
+            d = f_ss[i] * 125 + quarter_lap + penalty + last_lap
+            segments[rider].append((drag_adv[pos] * 0.5 * rho * rider_stats[rider]["AC"] * d,
+                                    (rider_stats[rider]["m_rider"] + m_sys) * g * Crr * d,
+                                    rider_stats[rider]["CP"] * d))
+        order = order[1:] + order[:1]
+    return segments, order
+
+def _suffix_block(segments, riders, num_suffixes):
+    # (riders, suffixes, 3) array of suffix sums; rows past a rider's own segments stay zero, which the clamp ignores
+    block = np.zeros((len(riders), num_suffixes, 3))
+    for k, rider in enumerate(riders):
+        rows = np.array(segments.get(rider, []), dtype=float).reshape(-1, 3)
+        block[k, :len(rows)] = np.cumsum(rows[::-1], axis=0)[::-1]
+    return block
+
+def compile_schedule(peel, switch_schedule, rider_stats, drag_adv, order = [1,2,3,4], rho = 1.225, Crr = 0.0018, g = 9.80665, bike_length = 2.1):
+    f_ss = format_ss(switch_schedule)
+    riders = list(order)
+    if peel:
+        f_ss1 = []
+        half_laps = 0
+        i = 0
+        while half_laps < peel:
+            f_ss1.append(f_ss[i])
+            half_laps += f_ss[i]
+            i += 1
+        segments1, order1 = _phase_coefficients(f_ss1, rider_stats, drag_adv, riders, False, rho, Crr, g, bike_length)
+        segments2, _ = _phase_coefficients(f_ss[i:], rider_stats, drag_adv, order1[:-1], True, rho, Crr, g, bike_length)
+        phases = [segments1, segments2]
+    else:
+        segments, _ = _phase_coefficients(f_ss, rider_stats, drag_adv, riders, True, rho, Crr, g, bike_length)
+        phases = [segments]
+    num_suffixes = max([len(rows) for segments in phases for rows in segments.values()] + [1])
+    # coefficients[phase, rider, suffix] . (v^2, 1, -1/v) is that suffix's energy
+    coefficients = np.stack([_suffix_block(segments, riders, num_suffixes) for segments in phases])
+    return {'riders': riders, 'coefficients': coefficients}
+
+# energy per rider at vel (a float or an array of velocities)
+def compiled_energy(compiled, vel):
+    v = np.asarray(vel, dtype=float)
+    basis = np.stack([v**2, np.ones_like(v), -1 / v])
+    suffix_energy = compiled['coefficients'] @ basis if v.ndim == 0 else np.einsum('prjc,c...->prj...', compiled['coefficients'], basis)
+    total = np.maximum(0, suffix_energy.max(axis=2)).sum(axis=0)
+    return dict(zip(compiled['riders'], total))
+
+def get_compiled_schedule(peel, switch_schedule, rider_stats, drag_adv, order = [1,2,3,4], rho = 1.225, Crr = 0.0018, g = 9.80665, bike_length = 2.1):
+    key = (peel, tuple(switch_schedule), tuple(order), tuple(drag_adv), rho, Crr, g, bike_length,
+           tuple((rider_stats[r]["AC"], rider_stats[r]["m_rider"], rider_stats[r]["CP"]) for r in order))
+    compiled = _compiled_schedules.get(key)
+    if compiled is None:
+        if len(_compiled_schedules) >= SCHEDULE_CACHE_SIZE:
+            _compiled_schedules.clear()
+        compiled = compile_schedule(peel, switch_schedule, rider_stats, drag_adv, order, rho, Crr, g, bike_length)
+        _compiled_schedules[key] = compiled
+    return compiled
+
+# Drop-in for race_energy (the ss_func of combined): compiles the schedule on first use and
+# keeps it in _compiled_schedules, so each velocity probe afterwards is one compiled_energy call.
+def race_energy_compiled(vel, peel, switch_schedule, rider_stats, drag_adv, order = [1,2,3,4], rho = 1.225, Crr = 0.0018, g = 9.80665, bike_length = 2.1):
+    compiled = get_compiled_schedule(peel, switch_schedule, rider_stats, drag_adv, order, rho, Crr, g, bike_length)
+    return compiled_energy(compiled, vel)
+
 def combined(acc_func, ss_func, peel, switch_schedule, drag_adv, df, rider_data, W_rem,
              order=[1,2,3,4], 
              min_v=15, max_v=22, precision=200, acc_length=3, 
@@ -405,7 +1051,7 @@ def combined(acc_func, ss_func, peel, switch_schedule, drag_adv, df, rider_data,
 
 # question: do we also need to include acceleration_length (number of half laps)?
 counter = 0 
-def black_box(schedule, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0=50):
+def black_box(schedule, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0=50, acc_func=accel_phase, solver=combined):
     try:
         # Create a full 32-length switch schedule from switch point list
         full_switch_schedule = [0] * 32
@@ -413,9 +1059,9 @@ def black_box(schedule, peel, initial_order, acceleration_length, drag_adv, df,
             if 0 <= point < 32:
                 full_switch_schedule[int(point)] = 1
 
-        v_out, t_out, *_ = combined(
-            accel_phase,
-            race_energy,
+        v_out, t_out, *_ = solver(
+            acc_func,
+            race_energy_compiled,
             peel,
             full_switch_schedule,
             drag_adv,
@@ -435,13 +1081,253 @@ def black_box(schedule, peel, initial_order, acceleration_length, drag_adv, df,
 
 
 
+# %%
+# Population-wide evaluation: black_box for a whole generation at once. The children share the leader, order and
+# acceleration length, so they share one accel_phase_curve; their compiled schedules are stacked into one
+# (child, phase, rider, suffix, 3) coefficient array, and every child's W' margin over the whole velocity grid
+# comes out of a single einsum. Vectorized regula falsi (Illinois) steps then pin down each child's limiting
+# velocity inside its first grid cell where a rider runs out, instead of combined's bisection over velocity.
+def black_box_batch(schedules, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0=50, curve_func=accel_phase_curve,
+                    min_v=15, max_v=22, rho=1.225, Crr=0.0018, g=9.80665, bike_length=2.1,
+                    m_wheels=0.75, v0=1.5, bank_angle=np.radians(12), xtol=1e-6, max_iter=30):
+    schedules = np.atleast_2d(np.asarray(schedules))
+    n = len(schedules)
+    try:
+        # full 32-length switch schedules, as black_box builds them
+        full_switch_schedules = np.zeros((n, 32), dtype=int)
+        rows, cols = np.nonzero((schedules >= 0) & (schedules < 32))
+        full_switch_schedules[rows, schedules[rows, cols].astype(int)] = 1
+
+        compiled = [get_compiled_schedule(peel - acceleration_length, list(full_switch_schedules[i, acceleration_length:]), rider_data, drag_adv, initial_order, rho, Crr, g, bike_length)
+                    for i in range(n)]
+        num_suffixes = max(c['coefficients'].shape[2] for c in compiled)
+        coefficients = np.zeros((n,) + compiled[0]['coefficients'].shape[:2] + (num_suffixes, 3))
+        for i, c in enumerate(compiled):
+            coefficients[i, :, :, :c['coefficients'].shape[2]] = c['coefficients']
+
+        leader = initial_order[0]
+        curve = curve_func(v0, P0, rider_data[leader]["Pmax"], initial_order, drag_adv, df, acceleration_length, bank_angle, rider_data=rider_data, W_rem_start=W_rem, rho=rho, m_wheels=m_wheels, g=g)
+        in_range = (curve['v_grid'] >= min_v) & (curve['v_grid'] <= max_v)
+        v_grid = curve['v_grid'][in_range]
+        if len(v_grid) == 0:
+            return np.full(n, np.inf)
+        W_acc = curve['W_rem'][:, in_range]
+
+        def margin(v, lanes):
+            # least W' left at the finish over the riders, one velocity per child in lanes
+            basis = np.stack([v**2, np.ones_like(v), -1 / v])
+            ss_energy = np.maximum(0, np.einsum('nprjc,cn->nprj', coefficients[lanes], basis).max(axis=3)).sum(axis=1)
+            acc = np.stack([np.interp(v, v_grid, row) for row in W_acc], axis=1)
+            return (acc - ss_energy).min(axis=1)
+
+        basis = np.stack([v_grid**2, np.ones_like(v_grid), -1 / v_grid])
+        ss_energy = np.maximum(0, np.einsum('nprjc,cg->nprjg', coefficients, basis).max(axis=3)).sum(axis=1)
+        short = ((W_acc[None] - ss_energy).min(axis=1) < 0)
+        first = np.argmax(short, axis=1)
+        v = np.where(short.any(axis=1), v_grid[first], v_grid[-1])
+
+        # children whose limit lies strictly inside the grid: bracket [v_grid[j - 1], v_grid[j]]
+        bracketed = np.nonzero(short.any(axis=1) & (first > 0))[0]
+        if len(bracketed):
+            lo, hi = v_grid[first[bracketed] - 1], v_grid[first[bracketed]]
+            f_lo, f_hi = margin(lo, bracketed), margin(hi, bracketed)
+            side = np.zeros(len(bracketed), dtype=int)
+            for _ in range(max_iter):
+                x = (lo * f_hi - hi * f_lo) / (f_hi - f_lo)
+                f_x = margin(x, bracketed)
+                below = f_x >= 0
+                # Illinois: halve the stale end's value when the same end is kept twice in a row
+                f_hi = np.where(below & (side == 1), f_hi / 2, f_hi)
+                f_lo = np.where(~below & (side == -1), f_lo / 2, f_lo)
+                lo, f_lo = np.where(below, x, lo), np.where(below, f_x, f_lo)
+                hi, f_hi = np.where(below, hi, x), np.where(below, f_hi, f_x)
+                side = np.where(below, 1, -1)
+                if np.all(hi - lo < xtol) or np.all(np.abs(f_x) < 1e-6):
+                    break
+            v[bracketed] = x
+
+        tfin = np.interp(v, v_grid, curve['tfin'][in_range])
+        global counter
+        counter += n
+        return tfin + (32 - acceleration_length) * 125 / v
+    except Exception:
+        logger.exception("black_box_batch crashed — dumping context")
+        return np.full(n, np.inf)
+
+# %%
+# Fitness cache shared by every search mode. A race time only depends on the switch points, peel, order,
+# acceleration length, P0, drag_adv, the riders' parameters and W', and the function that times it, so those form
+# the key. Entries live per process in _fitness_cache (least recently used evicted first), so the simulate_one tasks
+# a worker runs keep each other's scores; fitness_cache_stats counts hits and misses. A functools.partial evaluator
+# is keyed by its function and arguments, not by the object, since each task builds its own. multi_fidelity_batch
+# is never cached as a whole: its non-promoted times depend on the rest of the batch, so only its promoted
+# (full-fidelity) times are, under high_func's key.
+_fitness_cache = OrderedDict()
+FITNESS_CACHE_SIZE = 65536
+fitness_cache_stats = {'hits': 0, 'misses': 0}
+
+def _evaluator_key(evaluator):
+    if isinstance(evaluator, functools.partial):
+        return (_evaluator_key(evaluator.func), tuple(_evaluator_key(a) for a in evaluator.args),
+                tuple(sorted((name, _evaluator_key(value)) for name, value in evaluator.keywords.items())))
+    if isinstance(evaluator, tuple):
+        return tuple(_evaluator_key(e) for e in evaluator)
+    return evaluator
+
+def _fitness_key(schedule, peel, initial_order, acceleration_length, drag_adv, rider_data, W_rem, P0, evaluator):
+    return (tuple(int(p) for p in schedule), peel, tuple(initial_order), acceleration_length, float(P0),
+            tuple(float(x) for x in drag_adv), tuple((float(W_rem[r]),) + tuple(sorted(rider_data[r].items())) for r in initial_order),
+            _evaluator_key(evaluator))
+
+def _through_cache(schedules, keys, evaluate):
+    times = [None] * len(schedules)
+    missing = {}
+    for k, key in enumerate(keys):
+        if key in _fitness_cache:
+            _fitness_cache.move_to_end(key)
+            times[k] = _fitness_cache[key]
+            fitness_cache_stats['hits'] += 1
+        else:
+            missing.setdefault(key, []).append(k)
+    if missing:
+        fitness_cache_stats['misses'] += len(missing)
+        new_times = evaluate([schedules[ks[0]] for ks in missing.values()])
+        for (key, ks), t in zip(missing.items(), new_times):
+            for k in ks:
+                times[k] = t
+            _fitness_cache[key] = t
+            if len(_fitness_cache) > FITNESS_CACHE_SIZE:
+                _fitness_cache.popitem(last=False)
+    return times
+
+# black_box through the cache
+def cached_black_box(schedule, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0=50, acc_func=accel_phase, solver=combined):
+    key = _fitness_key(schedule, peel, initial_order, acceleration_length, drag_adv, rider_data, W_rem, P0, (black_box, acc_func, solver))
+    return _through_cache([schedule], [key], lambda missing: [black_box(missing[0], peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0, acc_func, solver)])[0]
+
+# batch_func (black_box_batch) through the cache; only the schedules not seen before are timed, in one call
+def cached_batch(schedules, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0=50, batch_func=black_box_batch):
+    base = batch_func.func if isinstance(batch_func, functools.partial) else batch_func
+    if base is multi_fidelity_batch:
+        # caches its promoted times itself
+        return np.asarray(batch_func(schedules, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0), dtype=float)
+    keys = [_fitness_key(schedule, peel, initial_order, acceleration_length, drag_adv, rider_data, W_rem, P0, batch_func) for schedule in schedules]
+    times = _through_cache(schedules, keys, lambda missing: batch_func(missing, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0))
+    return np.array(times, dtype=float)
+
+def fitness_cache_info():
+    return {**fitness_cache_stats, 'size': len(_fitness_cache), 'maxsize': FITNESS_CACHE_SIZE}
+
+# %%
+# Coarse-to-fine evaluation. multi_fidelity_batch is a batch_func that scores every schedule with low_func and
+# promotes only the best promote share (at least one) to high_func. By default low_func is coarse_black_box_batch:
+# black_box_batch on an acceleration curve from a 64-point power grid, dt = 0.2 s, the analytic constant-power
+# segment and a 0.05 m/s velocity grid. high_func is the full combined model, one black_box per schedule.
+# Schedules that are not promoted keep their low-fidelity time shifted by the mean high-minus-low offset of the
+# promoted ones, so all times stay comparable. multi_fidelity_stats counts how often the low-fidelity order of the
+# promoted schedules picked the same best one as the full model, and how many of their pairs it ordered the same way.
+COARSE_CURVE = {'num_P': 64, 'dt': 0.2, 'v_step': 0.05, 'integrator': 'analytic'}
+MULTI_FIDELITY_PROMOTE = 0.3
+multi_fidelity_stats = {'low': 0, 'high': 0, 'rankings': 0, 'best_agreed': 0, 'pairs': 0, 'pairs_agreed': 0}
+
+def coarse_accel_phase_curve(*args, **kwargs):
+    return accel_phase_curve(*args, **{**kwargs, **COARSE_CURVE})
+
+def coarse_black_box_batch(schedules, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0=50):
+    return black_box_batch(schedules, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0, curve_func=coarse_accel_phase_curve, xtol=1e-4)
+
+def full_black_box_batch(schedules, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0=50):
+    times = [black_box(list(schedule), peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0) for schedule in schedules]
+    return np.array([np.inf if t is None else t for t in times], dtype=float)
+
+def multi_fidelity_batch(schedules, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0=50,
+                         promote=None, low_func=coarse_black_box_batch, high_func=full_black_box_batch):
+    promote = MULTI_FIDELITY_PROMOTE if promote is None else promote
+    low = np.asarray(low_func(schedules, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0), dtype=float)
+    top = np.argsort(low, kind='stable')[:max(1, int(np.ceil(promote * len(low))))]
+    high = cached_batch([schedules[i] for i in top], peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0, high_func)
+    multi_fidelity_stats['low'] += len(low)
+    multi_fidelity_stats['high'] += len(top)
+
+    if len(top) >= 2:
+        # top is in low-fidelity order, so the low-fidelity best is top[0]
+        multi_fidelity_stats['rankings'] += 1
+        multi_fidelity_stats['best_agreed'] += int(np.argmin(high) == 0)
+        i, j = np.triu_indices(len(top), k=1)
+        multi_fidelity_stats['pairs'] += len(i)
+        multi_fidelity_stats['pairs_agreed'] += int(np.sum(np.sign(low[top][i] - low[top][j]) == np.sign(high[i] - high[j])))
+
+    finite = np.isfinite(high) & np.isfinite(low[top])
+    offset = np.mean(high[finite] - low[top][finite]) if finite.any() else 0
+    times = low + offset
+    times[top] = high
+    return times
+
+def multi_fidelity_info():
+    s = multi_fidelity_stats
+    return {**s, 'best_agreement': s['best_agreed'] / s['rankings'] if s['rankings'] else None,
+            'pair_agreement': s['pairs_agreed'] / s['pairs'] if s['pairs'] else None}
+
+# %%
+# Surrogate-assisted search. A surrogate is a small ridge regression from schedule features to race time, trained
+# online on every schedule the GA really times. The GA jitters oversample times as many children per parent, and once
+# the surrogate has seen min_samples races batch_times only simulates the keep share (at least one) of each brood
+# that it predicts fastest and skips the rest; the skipped children stay untested. The features are the riders' lead
+# half-laps (by starting position), their squares, the longest lead and longest turn, the number of turns and the
+# peel: the race is limited by whichever rider runs out of W' first, so time mostly follows how the leading is shared out.
+# Refitting and predicting cost about as much as timing a brood with black_box_batch, so the surrogate only pays when
+# races are expensive: the full combined model (full_black_box_batch, ~0.1 s a race) or the promoted multi-fidelity
+# path. There keep=0.2, oversample=2 times ~40% fewer races than the plain GA for the same results.
+def new_surrogate(keep=0.2, oversample=2, min_samples=20, ridge=1e-2):
+    return {'keep': keep, 'oversample': oversample, 'min_samples': min_samples, 'ridge': ridge, 'X': [], 'y': [], 'coef': None,
+            'evaluated': 0, 'skipped': 0}
+
+def schedule_features(schedule, peel, num_riders=4):
+    points = [0] + sorted(int(p) for p in schedule if 0 < p < 32) + [32]
+    turns = np.diff(points)
+    lead = np.zeros(num_riders)
+    rotation = list(range(num_riders))
+    for k, turn in enumerate(turns):
+        lead[rotation[0]] += turn
+        rotation = rotation[1:] + rotation[:1]
+        if points[k + 1] == peel and len(rotation) == num_riders:
+            rotation = rotation[:-1]    # the rider who just pulled off the front is the one dropped, as in race_energy
+    return np.concatenate([lead, lead ** 2, [lead.max(), turns.max(), len(turns), peel or 32]])
+
+def surrogate_update(surrogate, schedules, times, peel):
+    for schedule, t in zip(schedules, times):
+        if np.isfinite(t):
+            surrogate['X'].append(schedule_features(schedule, peel))
+            surrogate['y'].append(t)
+    surrogate['coef'] = None
+
+def surrogate_predict(surrogate, schedules, peel):
+    X = np.array(surrogate['X'])
+    mean, scale = X.mean(axis=0), X.std(axis=0) + 1e-9
+    if surrogate['coef'] is None:
+        Z = np.column_stack([np.ones(len(X)), (X - mean) / scale])
+        penalty = surrogate['ridge'] * len(X) * np.eye(Z.shape[1])
+        penalty[0, 0] = 0
+        surrogate['coef'] = np.linalg.solve(Z.T @ Z + penalty, Z.T @ np.array(surrogate['y']))
+    F = np.array([schedule_features(schedule, peel) for schedule in schedules])
+    return np.column_stack([np.ones(len(F)), (F - mean) / scale]) @ surrogate['coef']
+
+def surrogate_select(surrogate, schedules, peel):
+    if len(surrogate['y']) < surrogate['min_samples']:
+        return list(schedules)
+    predicted = surrogate_predict(surrogate, schedules, peel)
+    chosen = np.sort(np.argsort(predicted, kind='stable')[:max(1, int(np.ceil(surrogate['keep'] * len(schedules))))])
+    surrogate['skipped'] += len(schedules) - len(chosen)
+    return [schedules[i] for i in chosen]
+
 # %%
 ### this is helpful in the genetic algorithm (allows for the function to be minimum of this, but not maximum) 
 
-def sample_truncated_normal(center, min_, max_, std=1):
+# random_state (a seed or numpy Generator) replaces SciPy's global RNG, so a run can be repeated exactly
+def sample_truncated_normal(center, min_, max_, std=1, random_state=None):
     a = (min_ - 1 - center) / std
     b = (max_ - 1 - center) / std
-    return round(truncnorm.rvs(a, b, loc=center, scale=std))
+    return round(truncnorm.rvs(a, b, loc=center, scale=std, random_state=random_state))
 
 
 # uncomment below to see how it works (the max would be considered too big): 
@@ -470,13 +1356,14 @@ def replace_with_peel(peel, relevant_list):
 # %%
 # function that creates your list of 10 (11 if you count the parent) jittered options 
 
-def create_jittered_kids(parent, acceleration_length, num_changes, num_children, peel, parent_list):
-    parent_list.append(parent) #first append the parent to parent_list 
+def create_jittered_kids(parent, acceleration_length, num_changes, num_children, peel, parent_list, rng=None):
+    parent_list.add(tuple(parent)) #first append the parent to parent_list 
     warm_start = parent #for help with naming 
     #print("initial:", warm_start)
     all_children = []
     #all_children.append(warm_start) ### CHANGE HERE
     all_children.append(replace_with_peel(peel, warm_start[:]))
+    seen = {tuple(all_children[0])}
     #num_children=10000
     j = 1
     while j <= num_children: 
@@ -486,7 +1373,7 @@ def create_jittered_kids(parent, acceleration_length, num_changes, num_children,
             if i == 0: 
                 prev_jitter = 3
                 while prev_jitter <= acceleration_length:
-                    prev_jitter = sample_truncated_normal(center=warm_start[i], min_=warm_start[i]-(warm_start[i+1]-warm_start[i]), max_=warm_start[i+1])
+                    prev_jitter = sample_truncated_normal(center=warm_start[i], min_=warm_start[i]-(warm_start[i+1]-warm_start[i]), max_=warm_start[i+1], random_state=rng)
                     #print("tried this: ", jitter)
                 #print("first_jitter:", prev_jitter) 
                 jittered_list.append(prev_jitter)
@@ -495,7 +1382,7 @@ def create_jittered_kids(parent, acceleration_length, num_changes, num_children,
                 #print("initial:", warm_start[i])
                 jitter = -1
                 while jitter <= prev_jitter:
-                    jitter = sample_truncated_normal(center=warm_start[i], min_=warm_start[i-1], max_=warm_start[i+1])
+                    jitter = sample_truncated_normal(center=warm_start[i], min_=warm_start[i-1], max_=warm_start[i+1], random_state=rng)
                 #print("jitter:", jitter)
                 jittered_list.append(jitter)
                 prev_jitter = jitter 
@@ -504,12 +1391,13 @@ def create_jittered_kids(parent, acceleration_length, num_changes, num_children,
                 # I don't think we need all this, but whatever 
                 last_jitter = 50
                 while last_jitter > 32 or last_jitter <= prev_jitter:
-                    last_jitter = sample_truncated_normal(center=warm_start[i], min_=warm_start[i-1], max_=warm_start[i]+warm_start[i]-warm_start[i-1])
+                    last_jitter = sample_truncated_normal(center=warm_start[i], min_=warm_start[i-1], max_=warm_start[i]+warm_start[i]-warm_start[i-1], random_state=rng)
                     #last_jitter = sample_truncated_normal(center=36, min_=32, max_=40)
                 #print("last_jitter:",last_jitter) 
                 jittered_list.append(last_jitter)
-        if jittered_list not in all_children: 
+        if tuple(jittered_list) not in seen: 
             all_children.append(replace_with_peel(peel, jittered_list[:])) #CHANGE HERE, ADDED THIS
+            seen.add(tuple(all_children[-1]))
             j = j+1 # and this! 
             #if peel in jittered_list: ### IF WE ITERATE THROUGH PEELS, REMOVE THIS IF STATEMENT (OR MAKE IT ARBITRARY) 
                 #all_children.append(jittered_list)
@@ -518,7 +1406,51 @@ def create_jittered_kids(parent, acceleration_length, num_changes, num_children,
 
 
     return all_children, parent_list
-    
+
+# %%
+# Vectorized create_jittered_kids. The rejection loops above draw each switch point from sample_truncated_normal's
+# window until it lands after the previous point (and after the acceleration / no later than 32); that is the same
+# as drawing from the normal truncated to the window intersected with those limits, so a whole brood is drawn one
+# switch point at a time with inverse-CDF sampling from rng (a numpy Generator), without rejections.
+# standard normal truncated to [a, b] at quantile u; windows above the mean are mirrored so ndtr stays in its
+# accurate lower tail
+def _truncated_normal_ppf(u, a, b):
+    flip = a > 0
+    lo, hi = np.where(flip, -b, a), np.where(flip, -a, b)
+    z = ndtri(ndtr(lo) + u * (ndtr(hi) - ndtr(lo)))
+    return np.where(flip, -z, z)
+
+def _jitter_brood(parent, acceleration_length, size, rng, std=1):
+    w = np.asarray(parent, dtype=float)
+    lows = np.r_[2 * w[0] - w[1], w[:-1]] - 1
+    highs = np.r_[w[1:], 2 * w[-1] - w[-2]] - 1
+    highs[-1] = min(highs[-1], 32.5)
+    kids = np.zeros((size, len(w)))
+    valid = np.ones(size, dtype=bool)
+    prev = np.full(size, acceleration_length + 0.5)   # rounds to a point after the previous one
+    for i in range(len(w)):
+        lo = np.maximum(lows[i], prev)
+        valid &= lo < highs[i]
+        lo = np.where(valid, lo, highs[i] - 1)
+        kids[:, i] = np.rint(w[i] + std * _truncated_normal_ppf(rng.random(size), (lo - w[i]) / std, (highs[i] - w[i]) / std))
+        prev = kids[:, i] + 0.5
+    return kids[valid].astype(int)
+
+def create_jittered_kids_batch(parent, acceleration_length, num_changes, num_children, peel, parent_list, rng, max_broods=20):
+    parent_list.add(tuple(parent))
+    all_children = [replace_with_peel(peel, list(parent))]
+    seen = {tuple(all_children[0])}
+    for _ in range(max_broods):
+        brood = _jitter_brood(parent, acceleration_length, 2 * num_children, rng)
+        # replace_with_peel on every child at once
+        brood[np.arange(len(brood)), np.abs(brood - peel).argmin(axis=1)] = peel
+        for child in brood.tolist():
+            if tuple(child) not in seen:
+                seen.add(tuple(child))
+                all_children.append(child)
+                if len(all_children) > num_children:
+                    return all_children, parent_list
+    return all_children, parent_list
 
 # %%
 # returns teh top 4 from a list (can be changed to not be 4) 
@@ -536,12 +1468,33 @@ def create_jittered_kids(parent, acceleration_length, num_changes, num_children,
 #                     del my_dict[max(my_dict, key=my_dict.get)]
 #     return my_dict, tested_list
 
-def best_from_list(children, tested_list, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, num_seeds, P0=50):
+# with a batch_func (black_box_batch), every child not tested yet is timed in one call up front
+# with a surrogate only the children it picks are timed (and learnt from); the others are left out of the result
+def batch_times(children, tested_list, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0, batch_func, surrogate=None):
+    new_children = list(dict.fromkeys(tuple(child) for child in children if tuple(child) not in tested_list))
+    if not new_children:
+        return {}
+    if surrogate is not None:
+        new_children = surrogate_select(surrogate, new_children, peel)
+    times = cached_batch(new_children, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0, batch_func)
+    if surrogate is not None:
+        surrogate['evaluated'] += len(new_children)
+        surrogate_update(surrogate, new_children, times, peel)
+    return {tuple(child): t for child, t in zip(new_children, times)}
+
+def best_from_list(children, tested_list, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, num_seeds, P0=50, acc_func=accel_phase, solver=combined, batch_func=None, surrogate=None):
     my_dict = {}
+    if batch_func is not None:
+        times = batch_times(children, tested_list, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0, batch_func, surrogate)
     for child in children:
-        if child not in tested_list:
-            the_time = black_box(child, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0)
-            tested_list.append(child)
+        if tuple(child) not in tested_list:
+            if batch_func is not None:
+                if tuple(child) not in times:
+                    continue
+                the_time = times[tuple(child)]
+            else:
+                the_time = cached_black_box(child, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0, acc_func, solver)
+            tested_list.add(tuple(child))
             if len(my_dict) < num_seeds or the_time < max(my_dict.values()):
                 my_dict[tuple(child)] = the_time
                 if len(my_dict) > num_seeds:
@@ -623,18 +1576,61 @@ def best_from_list(children, tested_list, peel, initial_order, acceleration_leng
 #     return time_of_race, schedule_of_switches, sorted_dict
     
 
+# one round of the GA: every current seed not jittered yet gets children, and dict_of_top_4, tested_list and
+# parent_list are updated in place
+def ga_round(dict_of_top_4, tested_list, parent_list, jitter, peel, initial_order, acceleration_length, num_changes, num_children,
+             drag_adv, df, rider_data, W_rem, P0=50, acc_func=accel_phase, solver=combined, batch_func=None, surrogate=None):
+    list_of_active_parents = [list(key) for key in dict_of_top_4.keys()]
+    for a_list in list_of_active_parents:
+        if tuple(a_list) not in parent_list:
+            all_kids, parent_list = jitter(a_list, acceleration_length, num_changes, num_children, peel, parent_list)
+            if batch_func is not None:
+                times = batch_times(all_kids, tested_list, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0, batch_func, surrogate)
+            for a_kid in all_kids:
+                if tuple(a_kid) not in tested_list:
+                    if batch_func is not None:
+                        if tuple(a_kid) not in times:
+                            continue
+                        time_for_this_kid = times[tuple(a_kid)]
+                    else:
+                        time_for_this_kid = cached_black_box(a_kid, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0, acc_func, solver)
+                    tested_list.add(tuple(a_kid))
+                    if time_for_this_kid < max(dict_of_top_4.values()):
+                        dict_of_top_4[tuple(a_kid)] = time_for_this_kid
+                        del dict_of_top_4[max(dict_of_top_4, key=dict_of_top_4.get)]
+
 def genetic_algorithm(peel, initial_order, acceleration_length, num_changes,
                       drag_adv, df, rider_data, W_rem,
-                      num_children=10, num_seeds=4, num_rounds=5, P0=50):
+                      num_children=10, num_seeds=4, num_rounds=5, P0=50, acc_func=accel_phase, solver=combined, batch_func=None, rng=None,
+                      patience=None, min_improvement=0.0, time_budget=None, max_evaluations=None, return_stats=False, surrogate=None,
+                      should_stop=None):
+    # num_rounds is the most rounds run. Between rounds the GA also stops once the best time has not improved by more
+    # than min_improvement seconds for patience rounds in a row, once time_budget seconds have passed, or once
+    # max_evaluations schedules have been timed. return_stats adds which rule stopped it and how much it evaluated.
+    # surrogate (True or a dict from new_surrogate) screens every brood before it is timed, through batch_func
+    # (full_black_box_batch if none is given); the children it skipped are counted in the stats.
+    # should_stop is called before every round; once it returns True the GA returns its best so far ('cancelled').
+    start = time.time()
+    if surrogate is True:
+        surrogate = new_surrogate()
+    if surrogate is not None:
+        num_children = int(num_children * surrogate['oversample'])
+        batch_func = full_black_box_batch if batch_func is None else batch_func
+    # with an rng (a numpy Generator or a seed for one) children come from create_jittered_kids_batch
+    if rng is None:
+        jitter = create_jittered_kids
+    else:
+        rng = np.random.default_rng(rng)
+        jitter = lambda *args: create_jittered_kids_batch(*args, rng)
     
     warm_start = np.linspace(acceleration_length+1, 31.9, num=num_changes, dtype=int).tolist()
-    parent_list = []
+    parent_list = set()
 
-    fxn_output = create_jittered_kids(warm_start, acceleration_length, num_changes, num_children, peel, parent_list)
+    fxn_output = jitter(warm_start, acceleration_length, num_changes, num_children, peel, parent_list)
     all_children_from_fxn = fxn_output[0]
     parent_list = fxn_output[1]
 
-    tested_list = []
+    tested_list = set()
     dict_of_top_4, tested_list = best_from_list(
         all_children_from_fxn,
         tested_list,
@@ -646,27 +1642,558 @@ def genetic_algorithm(peel, initial_order, acceleration_length, num_changes,
         rider_data,
         W_rem,
         num_seeds,
-        P0
+        P0,
+        acc_func,
+        solver,
+        batch_func,
+        surrogate
     )
 
-    list_of_active_parents = [list(key) for key in dict_of_top_4.keys()]
-    
+    stats = {'rounds': 0, 'evaluations': len(tested_list), 'stopped_by': 'num_rounds'}
+    best = min(dict_of_top_4.values())
+    stale = 0
     for i in range(num_rounds):
-        for a_list in list_of_active_parents:
-            if a_list not in parent_list:
-                all_kids, parent_list = create_jittered_kids(a_list, acceleration_length, num_changes, num_children, peel, parent_list)
-                for a_kid in all_kids:
-                    if a_kid not in tested_list:
-                        time_for_this_kid = black_box(a_kid, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0)
-                        tested_list.append(a_kid)
-                        if time_for_this_kid < max(dict_of_top_4.values()):
-                            dict_of_top_4[tuple(a_kid)] = time_for_this_kid
-                            del dict_of_top_4[max(dict_of_top_4, key=dict_of_top_4.get)]
-        list_of_active_parents = [list(key) for key in dict_of_top_4.keys()]
+        if max_evaluations is not None and len(tested_list) >= max_evaluations:
+            stats['stopped_by'] = 'max_evaluations'
+            break
+        if time_budget is not None and time.time() - start >= time_budget:
+            stats['stopped_by'] = 'time_budget'
+            break
+        if should_stop is not None and should_stop():
+            stats['stopped_by'] = 'cancelled'
+            break
+        ga_round(dict_of_top_4, tested_list, parent_list, jitter, peel, initial_order, acceleration_length, num_changes, num_children,
+                 drag_adv, df, rider_data, W_rem, P0, acc_func, solver, batch_func, surrogate)
+        stats['rounds'] += 1
+        new_best = min(dict_of_top_4.values())
+        stale = 0 if best - new_best > min_improvement else stale + 1
+        best = new_best
+        if patience is not None and stale >= patience:
+            stats['stopped_by'] = 'patience'
+            break
+    stats['evaluations'] = len(tested_list)
+    if surrogate is not None:
+        stats['surrogate_skipped'] = surrogate['skipped']
 
     time_of_race = min(dict_of_top_4.values())
     schedule_of_switches = min(dict_of_top_4, key=dict_of_top_4.get)
     sorted_dict = dict(sorted(dict_of_top_4.items(), key=lambda item: item[1]))
 
+    if return_stats:
+        return time_of_race, schedule_of_switches, sorted_dict, stats
+    return time_of_race, schedule_of_switches, sorted_dict
+
+# %%
+# Island-model GA. num_islands populations, each with its own seeds, tested/parent sets and random stream, evolve
+# migration_interval rounds at a time side by side (through executor.map, e.g. a ProcessPoolExecutor, or one after
+# the other in this process without one). Between epochs the best num_migrants of every island join the next island
+# in a ring as seeds, if they beat its worst seed, so a good schedule found anywhere gets jittered everywhere.
+# should_stop is checked between epochs, like the GA's between rounds.
+def _evolve_island(island):
+    rng = island['rng']
+    jitter = lambda *args: create_jittered_kids_batch(*args, rng)
+    problem = island['problem']
+    peel, acceleration_length, num_changes, num_children = problem['peel'], problem['acceleration_length'], problem['num_changes'], problem['num_children']
+    physics = (problem['drag_adv'], problem['df'], problem['rider_data'], problem['W_rem'])
+    if island['top'] is None:
+        warm_start = np.linspace(acceleration_length+1, 31.9, num=num_changes, dtype=int).tolist()
+        children, island['parents'] = jitter(warm_start, acceleration_length, num_changes, num_children, peel, island['parents'])
+        island['top'], island['tested'] = best_from_list(children, island['tested'], peel, problem['initial_order'], acceleration_length, *physics,
+                                                         problem['num_seeds'], problem['P0'], batch_func=problem['batch_func'])
+    for _ in range(island['rounds']):
+        ga_round(island['top'], island['tested'], island['parents'], jitter, peel, problem['initial_order'], acceleration_length, num_changes, num_children,
+                 *physics, problem['P0'], batch_func=problem['batch_func'])
+    return island
+
+def island_genetic_algorithm(peel, initial_order, acceleration_length, num_changes,
+                             drag_adv, df, rider_data, W_rem,
+                             num_islands=4, migration_interval=2, num_migrants=1,
+                             num_children=10, num_seeds=4, num_rounds=5, P0=50, batch_func=black_box_batch, rng=None, executor=None,
+                             should_stop=None, return_stats=False):
+    problem = {'peel': peel, 'initial_order': list(initial_order), 'acceleration_length': acceleration_length, 'num_changes': num_changes,
+               'num_children': num_children, 'num_seeds': num_seeds, 'P0': P0, 'batch_func': batch_func,
+               'drag_adv': drag_adv, 'df': df, 'rider_data': rider_data, 'W_rem': W_rem}
+    if isinstance(rng, np.random.Generator):
+        rng = rng.integers(2**63)
+    streams = (rng if isinstance(rng, np.random.SeedSequence) else np.random.SeedSequence(rng)).spawn(num_islands)
+    islands = [{'problem': problem, 'rng': np.random.default_rng(stream), 'top': None, 'tested': set(), 'parents': set(), 'rounds': 0,
+                'received': 0} for stream in streams]
+    map_func = map if executor is None else executor.map
+
+    stats = {'rounds': 0, 'evaluations': 0, 'stopped_by': 'num_rounds'}
+    rounds_left = num_rounds
+    while True:
+        for island in islands:
+            island['rounds'] = min(migration_interval, rounds_left)
+        islands = list(map_func(_evolve_island, islands))
+        rounds_left -= islands[0]['rounds']
+        stats['rounds'] += islands[0]['rounds']
+        if rounds_left <= 0:
+            break
+        if should_stop is not None and should_stop():
+            stats['stopped_by'] = 'cancelled'
+            break
+        # ring migration: island k's best schedules become seeds on island k + 1
+        migrants = [sorted(island['top'].items(), key=lambda item: item[1])[:num_migrants] for island in islands]
+        for k, island in enumerate(islands):
+            for schedule, t in migrants[k - 1]:
+                if schedule not in island['tested']:
+                    island['received'] += 1
+                island['tested'].add(schedule)
+                if schedule not in island['top'] and t < max(island['top'].values()):
+                    island['top'][schedule] = t
+                    del island['top'][max(island['top'], key=island['top'].get)]
+
+    merged = {}
+    for island in islands:
+        merged.update(island['top'])
+    sorted_dict = dict(sorted(merged.items(), key=lambda item: item[1])[:num_seeds])
+    schedule_of_switches, time_of_race = next(iter(sorted_dict.items()))
+    # schedules each island timed itself; migrants were timed on the island they came from
+    stats['evaluations'] = sum(len(island['tested']) - island['received'] for island in islands)
+
+    if return_stats:
+        return time_of_race, schedule_of_switches, sorted_dict, stats
+    return time_of_race, schedule_of_switches, sorted_dict
+
+# %%
+# Joint search over peel and schedule. An individual is (peel, switch points) with the peel one of the points.
+# Children are jittered around their parent's schedule and snapped to its peel as usual; then, with probability
+# peel_jump, the peel moves to another of the child's points that is in peels. Every generation is timed through
+# cached_batch, one batch_func call per peel, so neighbouring peels share the fitness cache. should_stop works as in
+# genetic_algorithm.
+def _move_peel(child, peel, peels, rng, peel_jump):
+    if rng.random() >= peel_jump:
+        return peel
+    options = [point for point in child if point in peels and point != peel]
+    return int(rng.choice(options)) if options else peel
+
+def _time_by_peel(individuals, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0, batch_func):
+    by_peel = {}
+    for peel, schedule in individuals:
+        by_peel.setdefault(peel, []).append(schedule)
+    times = {}
+    for peel, schedules in by_peel.items():
+        for schedule, t in zip(schedules, cached_batch(schedules, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0, batch_func)):
+            times[(peel, schedule)] = t
+    return times
+
+def joint_genetic_algorithm(initial_order, acceleration_length, num_changes,
+                            drag_adv, df, rider_data, W_rem, peels=range(10, 33),
+                            num_children=20, num_seeds=8, num_rounds=20, P0=50, batch_func=black_box_batch, rng=None,
+                            peel_jump=0.3, patience=None, return_stats=False, should_stop=None):
+    rng = np.random.default_rng(rng)
+    peels = [peel for peel in peels if acceleration_length < peel <= 32]
+    warm_start = np.linspace(acceleration_length+1, 31.9, num=num_changes, dtype=int).tolist()
+
+    # one warm start per peel, so every peel is tried at least once
+    starts = list(dict.fromkeys((peel, tuple(replace_with_peel(peel, warm_start[:]))) for peel in peels))
+    times = _time_by_peel(starts, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0, batch_func)
+    tested_list = set(times)
+    dict_of_top_4 = dict(sorted(times.items(), key=lambda item: item[1])[:num_seeds])
+    parent_list = set()
+
+    stats = {'rounds': 0, 'evaluations': len(tested_list), 'stopped_by': 'num_rounds'}
+    best = min(dict_of_top_4.values())
+    stale = 0
+    for i in range(num_rounds):
+        if should_stop is not None and should_stop():
+            stats['stopped_by'] = 'cancelled'
+            break
+        kids = []
+        if all(seed in parent_list for seed in dict_of_top_4):
+            # every seed has been jittered once and none was beaten: jitter them again with fresh draws
+            parent_list.clear()
+        for peel, schedule in list(dict_of_top_4):
+            if (peel, schedule) not in parent_list:
+                parent_list.add((peel, schedule))
+                children, _ = create_jittered_kids_batch(list(schedule), acceleration_length, num_changes, num_children, peel, set(), rng)
+                kids.extend((_move_peel(child, peel, peels, rng, peel_jump), tuple(child)) for child in children)
+        kids = [kid for kid in dict.fromkeys(kids) if kid not in tested_list]
+        times = _time_by_peel(kids, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0, batch_func)
+        for kid in kids:
+            tested_list.add(kid)
+            if times[kid] < max(dict_of_top_4.values()):
+                dict_of_top_4[kid] = times[kid]
+                del dict_of_top_4[max(dict_of_top_4, key=dict_of_top_4.get)]
+        stats['rounds'] += 1
+        new_best = min(dict_of_top_4.values())
+        stale = 0 if new_best < best else stale + 1
+        best = new_best
+        if patience is not None and stale >= patience:
+            stats['stopped_by'] = 'patience'
+            break
+    stats['evaluations'] = len(tested_list)
+
+    sorted_dict = dict(sorted(dict_of_top_4.items(), key=lambda item: item[1]))
+    peel_and_schedule, time_of_race = next(iter(sorted_dict.items()))
+    if return_stats:
+        return time_of_race, peel_and_schedule, sorted_dict, stats
+    return time_of_race, peel_and_schedule, sorted_dict
+
+
+# %%
+# Exhaustive search with branch-and-bound. A schedule is a strictly increasing list of num_changes switch points
+# after the acceleration (a point of 32 means no switch), containing the peel, exactly the lists the genetic
+# algorithm draws from. The tree fixes one switch point per level; leaves are timed in batches by batch_func.
+#
+# Pruning: let v_k be the lowest velocity at which the race is as fast as the current k-th best time. A completion
+# of a prefix can only beat that if every rider is still W'-feasible at v_k (feasibility is taken to be monotone
+# in v, as the bisection in combined already assumes). The segments up to the last fixed point are known, and a
+# rider's energy after the running max(0, ...) clamp is at least the clamped energy so far plus the most it could
+# recover over the rest of the phase, min(0, best rate) * (distance left). If that lower bound already exceeds
+# some rider's W' after the acceleration at v_k, no completion can make the top k and the subtree is skipped.
+
+# energy per metre (A v^2 + B - C / v) for every rider in every position at velocity v
+def segment_rates(v, rider_stats, drag_adv, order, rho = 1.225, Crr = 0.0018, g = 9.80665, m_sys = 10.0):
+    return {rider: [drag_adv[pos] * 0.5 * rho * rider_stats[rider]["AC"] * v ** 2 + (rider_stats[rider]["m_rider"] + m_sys) * g * Crr - rider_stats[rider]["CP"] / v
+                    for pos in range(len(order))] for rider in order}
+
+# lower bound on each rider's steady-state energy (race_energy) over all schedules starting with prefix
+def schedule_energy_bound(prefix, rates, peel, acceleration_length, num_changes, order, bike_length = 2.1):
+    rotation = list(order)
+    energy = {rider: [0, 0] for rider in order}   # clamped energy before / after the peel
+    phase = 0
+    i = 0
+    points = [acceleration_length] + [p for p in prefix if p < 32]
+    for j in range(1, len(points)):
+        # every segment ending at a fixed point is followed by another one (at least the run in to the finish),
+        # so only the segment that ends at the peel is the last of its phase
+        closes_phase = phase == 0 and points[j] == peel
+        penalty = 0 if i == 0 else bike_length
+        for pos, rider in enumerate(rotation):
+            if pos == 0 and not closes_phase:
+                quarter_lap = 250 / 4
+            elif pos == len(rotation) - 1 and i > 0:
+                quarter_lap = -250 / 4
+            else:
+                quarter_lap = 0
+            d = (points[j] - points[j - 1]) * 125 + quarter_lap + penalty
+            energy[rider][phase] = max(0, energy[rider][phase] + rates[rider][pos] * d)
+        rotation = rotation[1:] + rotation[:1]
+        i += 1
+        if closes_phase:
+            phase = 1
+            i = 0
+            rotation = rotation[:-1]
+
+    # distance still to ride in the open phase, plus the largest quarter-lap and bike-length additions
+    slack = (num_changes - len(prefix) + 1) * (250 / 4 + bike_length)
+    phase_end = min(peel, 32) if phase == 0 else 32
+    distance_left = (phase_end - points[-1]) * 125 + slack
+    bound = {}
+    for rider in order:
+        recovery = min(0, min(rates[rider]))
+        bound[rider] = sum(energy[rider]) - energy[rider][phase] + max(0, energy[rider][phase] + recovery * distance_left)
+    return bound
+
+def exhaustive_search(peel, initial_order, acceleration_length, num_changes, drag_adv, df, rider_data, W_rem,
+                      P0=50, top_k=4, batch_size=512, batch_func=black_box_batch, curve_func=accel_phase_curve,
+                      return_stats=False, min_v=15, max_v=22, v0=1.5, bank_angle=np.radians(12)):
+    # peel may be a list of peels searched one after another against the same top_k; the cutoff does not depend on
+    # the peel, so a good schedule found at one peel prunes the others, and results are keyed (peel, schedule)
+    joint = not np.isscalar(peel)
+    peels = list(peel) if joint else [peel]
+    for peel in peels:
+        if not acceleration_length < peel <= 32:
+            raise ValueError(f"Peel {peel} must be after the acceleration ({acceleration_length} half laps) and at most 32.")
+
+    leader = initial_order[0]
+    curve = curve_func(v0, P0, rider_data[leader]["Pmax"], initial_order, drag_adv, df, acceleration_length, bank_angle, rider_data=rider_data, W_rem_start=W_rem)
+    in_range = (curve['v_grid'] >= min_v) & (curve['v_grid'] <= max_v)
+    v_grid = curve['v_grid'][in_range]
+    W_acc = curve['W_rem'][:, in_range]
+    t_grid = curve['tfin'][in_range] + (32 - acceleration_length) * 125 / v_grid
+
+    stats = {'nodes_explored': 0, 'nodes_pruned': 0, 'leaves_evaluated': 0}
+    best = []          # (time, schedule or (peel, schedule)), at most top_k, fastest first
+    pending = []
+    cutoff = {}        # the bound's inputs at v_k once there are top_k incumbents
+
+    def update_cutoff():
+        if len(best) < top_k:
+            return
+        fast_enough = np.nonzero(t_grid <= best[-1][0])[0]
+        if len(fast_enough) == 0:
+            return
+        j = fast_enough[0]
+        cutoff['rates'] = segment_rates(v_grid[j], rider_data, drag_adv, initial_order)
+        cutoff['W_acc'] = {rider: W_acc[pos, j] for pos, rider in enumerate(initial_order)}
+
+    def pruned(prefix):
+        if not cutoff:
+            return False
+        bound = schedule_energy_bound(prefix, cutoff['rates'], peel, acceleration_length, num_changes, initial_order)
+        return any(cutoff['W_acc'][rider] < bound[rider] for rider in initial_order)
+
+    def flush():
+        if not pending:
+            return
+        times = cached_batch(pending, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0, batch_func)
+        stats['leaves_evaluated'] += len(pending)
+        best.extend((t, (peel, tuple(schedule)) if joint else tuple(schedule)) for t, schedule in zip(times, pending) if np.isfinite(t))
+        best.sort(key=lambda item: item[0])
+        del best[top_k:]
+        pending.clear()
+        update_cutoff()
+
+    def expand(prefix):
+        stats['nodes_explored'] += 1
+        if prefix and pruned(prefix):
+            stats['nodes_pruned'] += 1
+            return
+        slot = len(prefix)
+        if slot == num_changes:
+            pending.append(prefix)
+            if len(pending) >= batch_size:
+                flush()
+            return
+        lo = prefix[-1] + 1 if prefix else acceleration_length + 1
+        hi = 32 - (num_changes - 1 - slot)
+        if peel not in prefix:
+            # the peel has to be one of the switch points
+            hi = min(hi, peel)
+            if slot == num_changes - 1:
+                lo = peel
+        for point in range(lo, hi + 1):
+            expand(prefix + [point])
+
+    for peel in peels:
+        expand([])
+        flush()
+    if not best:
+        raise ValueError(f"No feasible schedule with {num_changes} changes and peel {peels if joint else peel}.")
+
+    sorted_dict = {schedule: t for t, schedule in best}
+    time_of_race, schedule_of_switches = best[0]
+    if return_stats:
+        return time_of_race, schedule_of_switches, sorted_dict, stats
+    return time_of_race, schedule_of_switches, sorted_dict
+
+# %%
+# Dynamic programming over turn lengths. At a fixed velocity every segment adds rate * d to one rider (segment_rates),
+# so whether some schedule is W'-feasible can be decided walking the switch points left to right. A state is (half
+# lap of the last switch point, points so far, phase-1 segments if past the peel), which fixes the rotation, and
+# carries each rider's energy: the clamped phase-1 total once the peel is passed, and the running clamped total of
+# the open phase. The clamp is monotone, so per state only Pareto-minimal energy vectors are kept, and a vector is
+# dropped once the most it could still recover (as in schedule_energy_bound) leaves some rider over W'.
+# dp_optimizer bisects on velocity outside the DP, then times the schedules feasible at the limit with batch_func.
+def dp_feasible_schedules(rates, W_limit, peel, acceleration_length, num_changes, order, bike_length = 2.1, first_only = False, stats = None):
+    riders = list(order)
+    n = len(riders)
+    W = np.array([W_limit[rider] for rider in riders])
+    recovery = np.array([min(0, min(rates[rider])) for rider in riders])
+    slack = 250 / 4 + bike_length
+
+    def segment(rotation, i, closes_phase, end):
+        # energy per metre for each rider in riders and the extra distance on top of the segment's half laps
+        rate, extra = np.zeros(n), np.zeros(n)
+        for pos, rider in enumerate(rotation):
+            if pos == 0 and not closes_phase:
+                quarter_lap = 250 / 4
+            elif pos == len(rotation) - 1 and i > 0:
+                quarter_lap = -250 / 4
+            else:
+                quarter_lap = 0
+            last_lap = -250 / 4 if end else 0
+            k = riders.index(rider)
+            rate[k] = rates[rider][pos]
+            extra[k] = quarter_lap + (0 if i == 0 else bike_length) + last_lap
+        return rate, extra
+
+    def pareto(vectors, points):
+        vectors = np.vstack(vectors)
+        points = [p for chunk in points for p in chunk]
+        by_sum = np.argsort(vectors.sum(axis=1), kind='stable')
+        vectors = vectors[by_sum]
+        # an earlier (smaller sum) vector that is <= in every entry dominates, ties included
+        covers = np.all(vectors[:, None, :] <= vectors[None, :, :], axis=2)
+        dominated = np.triu(covers, k=1).any(axis=0)
+        return vectors[~dominated], [points[by_sum[k]] for k in np.nonzero(~dominated)[0]]
+
+    # states[h][(points, phase-1 segments or None)] = ([vector arrays (m, 2n): fixed | running], [point tuple lists])
+    states = {h: {} for h in range(acceleration_length, 33)}
+    states[acceleration_length][(0, None)] = ([np.zeros((1, 2 * n))], [[()]])
+    finals = []
+
+    def arrive(h, key, vectors, points):
+        if len(vectors):
+            chunks = states[h].setdefault(key, ([], []))
+            chunks[0].append(vectors)
+            chunks[1].append(points)
+
+    for h in range(acceleration_length, 32):
+        for (c, m), chunks in states[h].items():
+            vectors, points = pareto(*chunks)
+            if stats is not None:
+                stats['states'] += len(vectors)
+            fixed, running = vectors[:, :n], vectors[:, n:]
+            if m is None:
+                rotation = riders[c % n:] + riders[:c % n]
+                i, phase_end = c, peel
+            else:
+                after_peel = (riders[m % n:] + riders[:m % n])[:-1]
+                shift = (c - m) % len(after_peel)
+                rotation = after_peel[shift:] + after_peel[:shift]
+                i, phase_end = c - m, 32
+
+            # switch points strictly inside the phase; before the peel one point has to be left for the peel itself
+            # (the 32 in the list when the peel is at the finish)
+            last_inner = min(phase_end - 1, 31)
+            if last_inner > h and c + 1 + (m is None) <= num_changes:
+                rate, extra = segment(rotation, i, False, False)
+                h_next = np.arange(h + 1, last_inner + 1)
+                d = (h_next - h)[:, None] * 125 + extra
+                new_running = np.maximum(0, running[None] + (rate * d)[:, None, :])
+                left = (phase_end - h_next)[:, None, None] * 125 + (num_changes - c + 1) * slack
+                ok = np.all(fixed[None] + np.maximum(0, new_running + recovery * left) <= W, axis=2)
+                for a, point in enumerate(h_next):
+                    mask = ok[a]
+                    arrive(int(point), (c + 1, m), np.hstack([fixed, new_running[a]])[mask],
+                           [p + (int(point),) for p, good in zip(points, mask) if good])
+
+            # the segment that closes the open phase
+            end = m is not None or peel == 32
+            if end:
+                # the finish; 32 is a listed point when the peel is there, or when one point is left over
+                if peel == 32:
+                    complete, marker = c + 1 == num_changes, (32,)
+                else:
+                    complete, marker = c >= num_changes - 1, (32,) if c == num_changes - 1 else ()
+                if not complete:
+                    continue
+                rate, extra = segment(rotation, i, True, m is not None)
+                total = fixed + np.maximum(0, running + rate * ((32 - h) * 125 + extra))
+                ok = np.all(total <= W, axis=1)
+                finals.extend(p + marker for p, good in zip(points, ok) if good)
+                if first_only and finals:
+                    return finals
+            elif c + 1 <= num_changes and h < peel:
+                rate, extra = segment(rotation, i, True, False)
+                closed = np.maximum(0, running + rate * ((peel - h) * 125 + extra))
+                mask = np.all(closed <= W, axis=1)
+                arrive(peel, (c + 1, c + 1), np.hstack([closed, np.zeros_like(closed)])[mask],
+                       [p + (peel,) for p, good in zip(points, mask) if good])
+    return finals
+
+def dp_optimizer(peel, initial_order, acceleration_length, num_changes, drag_adv, df, rider_data, W_rem,
+                 P0=50, top_k=4, batch_func=black_box_batch, curve_func=accel_phase_curve, return_stats=False,
+                 min_v=15, max_v=22, v0=1.5, bank_angle=np.radians(12), xtol=1e-4):
+    if not acceleration_length < peel <= 32:
+        raise ValueError(f"Peel {peel} must be after the acceleration ({acceleration_length} half laps) and at most 32.")
+
+    leader = initial_order[0]
+    curve = curve_func(v0, P0, rider_data[leader]["Pmax"], initial_order, drag_adv, df, acceleration_length, bank_angle, rider_data=rider_data, W_rem_start=W_rem)
+    in_range = (curve['v_grid'] >= min_v) & (curve['v_grid'] <= max_v)
+    v_grid = curve['v_grid'][in_range]
+    W_acc = curve['W_rem'][:, in_range]
+    stats = {'states': 0, 'velocities_tried': 0}
+
+    def schedules_at(v, first_only):
+        stats['velocities_tried'] += 1
+        rates = segment_rates(v, rider_data, drag_adv, initial_order)
+        W_limit = {rider: np.interp(v, v_grid, W_acc[pos]) for pos, rider in enumerate(initial_order)}
+        return dp_feasible_schedules(rates, W_limit, peel, acceleration_length, num_changes, initial_order, first_only=first_only, stats=stats)
+
+    # fastest velocity with a feasible schedule (feasibility is monotone in v, as the bisection in combined assumes)
+    if len(v_grid) == 0 or not schedules_at(v_grid[0], True):
+        raise ValueError(f"No feasible schedule with {num_changes} changes and peel {peel}.")
+    lo, hi = v_grid[0], v_grid[-1]
+    if schedules_at(hi, True):
+        lo = hi
+    while hi - lo > xtol:
+        mid = (lo + hi) / 2
+        if schedules_at(mid, True):
+            lo = mid
+        else:
+            hi = mid
+
+    # every Pareto-optimal schedule at that velocity, timed exactly
+    candidates = [list(p) for p in dict.fromkeys(schedules_at(lo, False))]
+    times = cached_batch(candidates, peel, initial_order, acceleration_length, drag_adv, df, rider_data, W_rem, P0, batch_func)
+    ranked = sorted(zip(times, map(tuple, candidates)), key=lambda item: item[0])[:top_k]
+    sorted_dict = {schedule: t for t, schedule in ranked}
+    time_of_race, schedule_of_switches = ranked[0]
+    if return_stats:
+        stats['candidates'] = len(candidates)
+        return time_of_race, schedule_of_switches, sorted_dict, stats
     return time_of_race, schedule_of_switches, sorted_dict
 
+# %%
+# Pre-screen of (peel, order, acc length, changes) tasks. race_time_bounds gives a lower and an upper bound on the
+# best race time a task can reach, without searching it:
+# - upper: the time of the warm start snapped to the peel, which every search mode evaluates first.
+# - lower: the time at the fastest velocity that passes two necessary conditions for any schedule. Every rider has
+#   W' left after the acceleration, and the team's W' covers the team's steady-state energy. Each rider's clamped
+#   energy is at least its unclamped sum, and summed over riders that is at least, position by position, the
+#   distance ridden there (half laps plus the quarter-lap and bike-length shifts of m segments) times the lowest
+#   rider rate at that position. m and the rider left out after the peel (set by m) are minimised over.
+# A task whose lower bound is above the keep-th best upper bound cannot make the top keep.
+def team_energy_bound(rates, order, half_laps, num_segments, end, bike_length = 2.1):
+    shifts = np.full(len(order), bike_length * (num_segments - 1) - (250 / 4 if end else 0))
+    shifts[0] += 250 / 4 * (num_segments - 1)
+    shifts[-1] -= 250 / 4 * (num_segments - 1)
+    cheapest = np.min([[rates[rider][pos] for pos in range(len(order))] for rider in order], axis=0)
+    return sum((half_laps * 125 + shifts[pos]) * cheapest[pos] for pos in range(len(order)))
+
+def race_time_bounds(peel, initial_order, acceleration_length, num_changes, drag_adv, df, rider_data, W_rem,
+                     P0=50, batch_func=black_box_batch, curve_func=accel_phase_curve,
+                     min_v=15, max_v=22, v0=1.5, bank_angle=np.radians(12), bike_length=2.1):
+    # peel may be a list of peels, as in exhaustive_search; the bounds are then over all of them
+    peels = list(peel) if not np.isscalar(peel) else [peel]
+    order = list(initial_order)
+    leader = order[0]
+    curve = curve_func(v0, P0, rider_data[leader]["Pmax"], order, drag_adv, df, acceleration_length, bank_angle, rider_data=rider_data, W_rem_start=W_rem)
+    in_range = (curve['v_grid'] >= min_v) & (curve['v_grid'] <= max_v)
+    v_grid = curve['v_grid'][in_range]
+    if len(v_grid) == 0:
+        return np.inf, np.inf
+    W_acc = curve['W_rem'][:, in_range]
+    t_grid = curve['tfin'][in_range] + (32 - acceleration_length) * 125 / v_grid
+    rates = segment_rates(v_grid, rider_data, drag_adv, order)
+
+    passes = np.zeros(len(v_grid), dtype=bool)
+    upper = np.inf
+    for peel in peels:
+        need = np.full(len(v_grid), np.inf)
+        if peel == 32:
+            for m1 in range(1, num_changes + 1):
+                need = np.minimum(need, team_energy_bound(rates, order, 32 - acceleration_length, m1, False, bike_length))
+        else:
+            for m1 in range(1, num_changes + 1):
+                phase1 = team_energy_bound(rates, order, peel - acceleration_length, m1, False, bike_length)
+                after_peel = (order[m1 % 4:] + order[:m1 % 4])[:-1]
+                for m2 in range(1, num_changes - m1 + 2):
+                    need = np.minimum(need, phase1 + team_energy_bound(rates, after_peel, 32 - peel, m2, True, bike_length))
+        passes |= (W_acc.min(axis=0) >= 0) & (W_acc.sum(axis=0) >= need)
+
+        warm_start = np.linspace(acceleration_length+1, 31.9, num=num_changes, dtype=int).tolist()
+        schedule = replace_with_peel(peel, warm_start)
+        upper = min(upper, cached_batch([schedule], peel, order, acceleration_length, drag_adv, df, rider_data, W_rem, P0, batch_func)[0])
+
+    if not passes.any():
+        return np.inf, upper
+    # one grid step of headroom, since the true limit can sit between grid points
+    fastest = min(np.nonzero(passes)[0][-1] + 1, len(v_grid) - 1)
+    return t_grid[:fastest + 1].min(), upper
+
+# whether any schedule of the task can finish in time_to_beat: a single dp_feasible_schedules run at the grid
+# velocity just below the lowest one that is that fast, so a limit inside that grid cell still counts (feasibility
+# taken as monotone in v, as in combined)
+def can_beat(time_to_beat, peel, initial_order, acceleration_length, num_changes, drag_adv, df, rider_data, W_rem,
+             P0=50, curve_func=accel_phase_curve, min_v=15, max_v=22, v0=1.5, bank_angle=np.radians(12)):
+    peels = list(peel) if not np.isscalar(peel) else [peel]
+    order = list(initial_order)
+    leader = order[0]
+    curve = curve_func(v0, P0, rider_data[leader]["Pmax"], order, drag_adv, df, acceleration_length, bank_angle, rider_data=rider_data, W_rem_start=W_rem)
+    in_range = (curve['v_grid'] >= min_v) & (curve['v_grid'] <= max_v)
+    v_grid = curve['v_grid'][in_range]
+    W_acc = curve['W_rem'][:, in_range]
+    t_grid = curve['tfin'][in_range] + (32 - acceleration_length) * 125 / v_grid
+    fast_enough = np.nonzero(t_grid <= time_to_beat)[0]
+    if len(fast_enough) == 0:
+        return False
+    j = max(fast_enough[0] - 1, 0)
+    rates = segment_rates(v_grid[j], rider_data, drag_adv, order)
+    W_limit = {rider: W_acc[pos, j] for pos, rider in enumerate(order)}
+    return any(dp_feasible_schedules(rates, W_limit, peel, acceleration_length, num_changes, order, first_only=True) for peel in peels)
@@ -8,6 +8,8 @@ import time
 
 from itertools import combinations, permutations
 
+from final_optimization import simulate_accel_phase_rk4
+
 import matplotlib.pyplot as plt
 from matplotlib.patches import Patch
 
@@ -46,7 +48,11 @@ def get_rider_info(num, df, number_to_name):
     return W_prime, CP, AC, Pmax, m_rider
 
 
-def simulate_accel_phase_with_thalf(s, P_const, num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, Crr=0.0018, rho=1.225, dt=0.05):
+# integrator='rk4' runs final_optimization.simulate_accel_phase_rk4 (RK4 steps with exact crossing times) instead
+# of fixed-step Euler; its output is still sampled every dt, so the plots below work unchanged.
+def simulate_accel_phase_with_thalf(s, P_const, num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, Crr=0.0018, rho=1.225, dt=0.05, integrator='euler', rk_step=0.5):
+    if integrator == 'rk4':
+        return simulate_accel_phase_rk4(s, P_const, num_of_half_laps, m_rider, m_wheels, P_init, v0, CdA, CP, rho, dt, rk_step)
     track_half_lap = 125
     M = m_rider + m_wheels
     drag_coeff = 0.5 * rho * CdA
@@ -107,7 +113,7 @@ def simulate_accel_phase_with_thalf(s, P_const, num_of_half_laps, m_rider, m_whe
 
 
 # Updated optimizer to return t_half
-def find_best_power_profile(s_range, P_bounds, num_of_half_laps, v_target, m_rider, m_wheels, P_init, v0, CdA, CP, epsilon=0.4, rho=1.225):
+def find_best_power_profile(s_range, P_bounds, num_of_half_laps, v_target, m_rider, m_wheels, P_init, v0, CdA, CP, epsilon=0.4, rho=1.225, integrator='euler'):
     # start_time2 = time.time()
     best_result = None
     min_Wprime = float('inf')
@@ -117,7 +123,7 @@ def find_best_power_profile(s_range, P_bounds, num_of_half_laps, v_target, m_rid
 
         def v_error(P):
             try:
-                result = simulate_accel_phase_with_thalf(s, P, num_of_half_laps,  m_rider, m_wheels, P_init, v0, CdA, CP, rho)
+                result = simulate_accel_phase_with_thalf(s, P, num_of_half_laps,  m_rider, m_wheels, P_init, v0, CdA, CP, rho, integrator=integrator)
                 cached_result["result"] = result  # store it to avoid recomputation
                 _, _, v_final, _, _, _ = result
                 # print(f"s={s:.1f}, P={P:.1f}, v_final={v_final:.2f}, target={v_target:.2f}")
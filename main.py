@@ -1,22 +1,39 @@
-from fastapi import FastAPI, BackgroundTasks, HTTPException
+from fastapi import FastAPI, HTTPException
 from datetime import datetime
-from final_optimization import genetic_algorithm
+from final_optimization import multi_fidelity_batch, multi_fidelity_stats, genetic_algorithm, island_genetic_algorithm, joint_genetic_algorithm, black_box_batch, exhaustive_search, dp_optimizer, race_time_bounds, can_beat
 import itertools
+import functools
+import math
 from googleapiclient import discovery
 from google.auth import compute_engine
 import time
 from threading import Thread
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait
 import uuid
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, model_validator
 import pandas as pd
+import numpy as np
 import re
-from typing import Tuple, Dict, Any
+from typing import Tuple, Dict, Any, Literal
 import traceback, logging
+import os, pickle, tempfile, threading
+from collections import deque
+from contextlib import asynccontextmanager
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # one warm worker pool for every job the app runs
+    start_pool()
+    yield
+    stop_pool()
+
+app = FastAPI(lifespan=lifespan)
 jobs: dict[str, dict] = {}        # job_id ➜ {"state": "...", "progress": 0-100, "result": …}
+TOP_N = 5                         # results reported per job; the pre-screen keeps every task that could make it
+NUM_ISLANDS = 8                   # island search populations; fixed, so a seeded result never depends on the core count
+MAX_RUNNING_JOBS = int(os.environ.get("MAX_RUNNING_JOBS", 1))   # jobs sharing the worker pool at once
+MAX_QUEUED_JOBS  = int(os.environ.get("MAX_QUEUED_JOBS", 8))    # waiting jobs before new ones are turned away
 
 class OptRequest(BaseModel):
     workbook: str
@@ -25,6 +42,20 @@ class OptRequest(BaseModel):
     rho: float
     Crr: float
     v0: float
+    search: Literal["genetic", "exhaustive", "dp", "island", "joint"] = "genetic"
+    # GA only: share of each generation promoted from the coarse model to the full combined model (None = batch model only)
+    promote: float | None = Field(None, gt=0, le=1)
+    # GA only, with promote: let an online regression pick which children of each generation are actually simulated.
+    # Fitting it costs about as much as timing a generation with the batch model, so it needs the promoted full model
+    surrogate: bool = False
+    # seed for the GA searches' random streams; the same request and seed always give the same top results
+    seed: int = Field(0, ge=0)
+
+    @model_validator(mode="after")
+    def surrogate_needs_promote(self):
+        if self.surrogate and self.promote is None:
+            raise ValueError("surrogate only applies with promote")
+        return self
 
 def run_opt_job(job_id: str):
     ctx    = jobs[job_id]["ctx"]
@@ -35,33 +66,92 @@ def run_opt_job(job_id: str):
         t0 = time.time()
 
         # 1) Build your tasks _first_
+        # the joint search picks the peel itself, so it needs one task per (acc length, order, changes)
+        peels = [None] if ctx.get("search") == "joint" else range(10, 33)
         tasks = [
-            (al, peel, order, chg, ctx)
+            (al, peel, order, chg)
             for al in [3, 4]
-            for peel in range(10, 33)
+            for peel in peels
             for order in itertools.permutations(r_ids)
             for chg in [3, 5]
         ]
-        total_tasks = len(tasks)
 
         # 2) Mark job as running, progress = 0
         jobs[job_id] = {"state": "running", "progress": 0}
 
         total_races = 0
         results     = []
+        fidelity    = {}
+        races_skipped = 0
+        search_stats  = {}
+
+        context = {**worker_context(ctx), "cancel_marker": cancel_marker(job_id)}
+        cancelled = lambda: job_id in cancelled_jobs
+        ref = pool = None
+        try:
+            ref  = publish_context(context)
+            pool = acquire_pool()
+            # 2b) Pre-screen: drop tasks that provably cannot reach the top TOP_N. The TOP_N-th best warm start time
+            #     is reached by at least TOP_N tasks; a task is skipped when its steady-state lower bound is slower,
+            #     or when no schedule of it is W'-feasible at the velocity needed to be faster.
+            #     The bounds are on black_box_batch times, so a GA job with promote (whose best times come from the
+            #     full combined model) keeps every task.
+            tasks_skipped = 0
+            if not (ctx.get("search") == "genetic" and ctx.get("promote") is not None):
+                bounds = [None] * len(tasks)
+                for k, bound in run_tasks(pool, bound_one, ref, tasks, cancelled=cancelled, count=False):
+                    bounds[k] = bound
+                uppers = sorted(upper for _, upper in bounds)
+                cutoff = uppers[TOP_N - 1] if len(uppers) >= TOP_N else float("inf")
+                candidates = [task for task, (lower, _) in zip(tasks, bounds) if lower <= cutoff]
+                keep = [None] * len(candidates)
+                for k, ok in run_tasks(pool, screen_one, ref, [(task, cutoff) for task in candidates], cancelled=cancelled,
+                                       count=False):
+                    keep[k] = ok
+                screened = [task for task, ok in zip(candidates, keep) if ok]
+                tasks_skipped = len(tasks) - len(screened)
+                tasks = screened
+            total_tasks = max(len(tasks), 1)
+            logger.info("run_opt_job %s: pre-screen kept %d tasks, skipped %d", job_id, len(tasks), tasks_skipped)
 
-        # 3) Execute and update progress
-        with ProcessPoolExecutor() as pool:
-            for i, res in enumerate(pool.map(simulate_one, tasks), start=1):
+            # 3) Execute and update progress
+            if ctx.get("search") == "island":
+                # one task at a time, its islands spread over the pool
+                state    = {**worker_state(context), "ref": ref}
+                def island_outcomes():
+                    for task in tasks:
+                        res = simulate_one(task, pool, state)
+                        count_tasks(NUM_ISLANDS)
+                        yield res
+                outcomes = island_outcomes()
+            else:
+                # longest tasks first, in shrinking chunks, collected as they finish
+                outcomes = (res for _, res in run_tasks(pool, simulate_one, ref, tasks, expected_cost, cancelled))
+            for i, res in enumerate(outcomes, start=1):
+                if cancelled():
+                    # closing run_tasks drops the chunks still queued before the job reports cancelled
+                    outcomes.close()
+                    raise JobCancelled()
                 # bump progress
                 jobs[job_id]["progress"] = int(i / total_tasks * 100)
 
                 if res["success"]:
                     results.append(res["result"])
                     total_races += res["races"]
+                    for key, count in res.get("fidelity", {}).items():
+                        fidelity[key] = fidelity.get(key, 0) + count
+                    races_skipped += res.get("races_skipped", 0)
+                    add_search_stats(search_stats, res.get("stats", {}))
+        finally:
+            # undo only what was set up, so a failed publish or pool start does not hide its own error
+            if pool is not None:
+                release_pool()
+            if ref is not None:
+                os.remove(ref)
 
         # 4) Finalise the job dict in-place
-        top5    = sorted(results, key=lambda x: x[1])[:5]
+        # ties broken on the schedule itself, so the top results never depend on which worker finished first
+        top5    = sorted(results, key=lambda x: (x[1], x[0]))[:5]
         runtime = time.time() - t0
 
         jobs[job_id].update({
@@ -69,6 +159,17 @@ def run_opt_job(job_id: str):
             "progress":            100,
             "runtime_seconds":     runtime,
             "total_races_simulated": total_races,
+            "tasks_skipped":       tasks_skipped,
+            "seed":                ctx.get("seed", 0),
+            "races_skipped_by_surrogate": races_skipped,
+            # the searches' own counters summed over the tasks, and how many of them each stopping rule ended
+            "search_stats":        search_stats,
+            # named as in multi_fidelity_info, so the ratios never clash with the raw counters; None without promote
+            "low_fidelity_agreement": {
+                **fidelity,
+                "best_agreement": fidelity["best_agreed"] / fidelity["rankings"] if fidelity["rankings"] else None,
+                "pair_agreement": fidelity["pairs_agreed"] / fidelity["pairs"] if fidelity["pairs"] else None,
+            } if fidelity.get("low", 0) > 0 else None,
             "top_results": [
                 {
                     "time":          t,
@@ -80,41 +181,340 @@ def run_opt_job(job_id: str):
             ],
         })
 
-        # Optional shutdown
-        Thread(target=trigger_shutdown, daemon=True).start()
-
+    except JobCancelled:
+        jobs[job_id].update({"state": "cancelled", "runtime_seconds": time.time() - t0})
     except Exception as e:
         jobs[job_id].update({"state": "error", "error": str(e)})
-def simulate_one(args):
-    accel_len, peel, order, changes, ctx = args
-    df        = ctx["df"]
-    drag_adv  = ctx["drag_adv"]
-    # shift to zero-based IDs:
-    rider_ids = ctx["rider_ids"]
-    rider_ids = [r-1 for r in rider_ids]
-    order     = tuple(r-1 for r in order)
+# Worker context. Everything a task needs besides its own (acc length, peel, order, changes) reaches each worker
+# once per job: the chosen riders as a small NumPy record array rather than the whole DataFrame, plus the job
+# settings. The job publishes it to a file and its tasks only carry the file's path (see in_context); each worker
+# loads it on its first task of the job and keeps rider_data and W_rem in _worker.
+RIDER_DTYPE = np.dtype([("id", "i4"), ("W_prime", "f8"), ("CP", "f8"), ("AC", "f8"), ("Pmax", "f8"), ("m_rider", "f8")])
+_worker: dict[str, Any] = {}
 
-    def info(rid):
+def worker_context(ctx):
+    df     = ctx["df"]
+    riders = np.zeros(len(ctx["rider_ids"]), dtype=RIDER_DTYPE)
+    # shift to zero-based IDs:
+    for k, rid in enumerate(r-1 for r in ctx["rider_ids"]):
         try:
             row = df.iloc[rid]
         except IndexError:
             raise ValueError(f"Bad rider index {rid}: df has {len(df)} rows")
-        return {
-            "W_prime": float(row["W'"]) * 1000,
-            "CP":      float(row["CP"]),
-            "AC":      float(row["CdA"]),
-            "Pmax":    float(row["Pmax"]),
-            "m_rider": float(row["Mass"]),
-        }
+        riders[k] = (rid, float(row["W'"]) * 1000, float(row["CP"]), float(row["CdA"]), float(row["Pmax"]), float(row["Mass"]))
+    return {"riders": riders, **{key: ctx.get(key) for key in ("drag_adv", "search", "promote", "surrogate", "seed")}}
+
+def worker_state(context):
+    riders     = context["riders"]
+    rider_data = {int(r["id"]): {name: float(r[name]) for name in RIDER_DTYPE.names[1:]} for r in riders}
+    W_rem      = [rider_data[int(rid)]["W_prime"] for rid in riders["id"]]
+    return {**context, "rider_data": rider_data, "W_rem": W_rem}
+
+def publish_context(context):
+    fd, ref = tempfile.mkstemp(prefix="opt-context-", suffix=".pkl")
+    with os.fdopen(fd, "wb") as f:
+        pickle.dump(context, f)
+    return ref
+
+# A job is cancelled by creating its cancel marker file, which every worker can see.
+def cancel_marker(job_id):
+    return os.path.join(tempfile.gettempdir(), f"opt-cancel-{job_id}")
+
+def cancel_requested(state=None):
+    state = state or _worker
+    return os.path.exists(state["cancel_marker"])
+
+def in_context(func, ref, task):
+    global _worker
+    if _worker.get("ref") != ref:
+        with open(ref, "rb") as f:
+            _worker = {**worker_state(pickle.load(f)), "ref": ref}
+    return func(task)
+
+# Persistent worker pool. The app's lifespan starts one ProcessPoolExecutor for all jobs and warms it, so a job
+# starts computing straight away instead of paying for process start-up and the numpy/scipy/pandas imports. Before a
+# job uses the pool, check_pool pings every worker and rebuilds the pool if it broke or a worker stopped answering;
+# while other jobs are running it only checks that the pool is not broken, as pings would queue behind their tasks.
+# Once the pool has finished WORKER_MAX_TASKS tasks per worker it is recycled between jobs (ProcessPoolExecutor's own
+# max_tasks_per_child can hang on Python 3.11 when a worker retires). Only optimizer tasks count, once finished:
+# run_tasks counts what its chunks ran (unless count is False, as for the pre-screen's bound checks) and the island
+# search a task's worth per island.
+WORKERS             = os.cpu_count() or 1
+WORKER_MAX_TASKS    = 5000
+WORKER_PING_TIMEOUT = 30       # seconds
+worker_pool: dict[str, Any] = {"executor": None, "active_jobs": 0, "tasks": 0, "started": None, "rebuilds": 0,
+                               "recycles": 0, "last_check": None, "healthy": None, "pids": []}
+_pool_lock = threading.Lock()
+
+def ping_worker(_=None):
+    # held briefly, so the pings land on (and start) different workers
+    time.sleep(0.1)
+    return os.getpid()
+
+def new_pool():
+    # call with _pool_lock held
+    worker_pool["executor"] = ProcessPoolExecutor(max_workers=WORKERS)
+    worker_pool["started"]  = datetime.now().isoformat()
+    worker_pool["tasks"]    = 0
+    return worker_pool["executor"]
+
+def start_pool():
+    with _pool_lock:
+        if worker_pool["executor"] is None:
+            new_pool()
+        check_pool()
+    return worker_pool["executor"]
+
+def stop_pool():
+    with _pool_lock:
+        if worker_pool["executor"] is not None:
+            worker_pool["executor"].shutdown(wait=False, cancel_futures=True)
+            worker_pool["executor"] = None
+
+def check_pool():
+    # call with _pool_lock held
+    executor = worker_pool["executor"]
+    if worker_pool["active_jobs"] == 0 and worker_pool["tasks"] >= WORKERS * WORKER_MAX_TASKS:
+        executor.shutdown(wait=True)
+        executor = new_pool()
+        worker_pool["recycles"] += 1
+    for attempt in range(2):
+        try:
+            if getattr(executor, "_broken", False):
+                raise RuntimeError(executor._broken)
+            if worker_pool["active_jobs"] == 0:
+                futures = [executor.submit(ping_worker) for _ in range(WORKERS)]
+                worker_pool["pids"] = sorted({future.result(timeout=WORKER_PING_TIMEOUT) for future in futures})
+            worker_pool["healthy"] = True
+            break
+        except Exception as e:
+            logger.warning("worker_pool unhealthy (%r), rebuilding", e)
+            executor.shutdown(wait=False, cancel_futures=True)
+            executor = new_pool()
+            worker_pool["rebuilds"] += 1
+            worker_pool["healthy"]  = False
+            worker_pool["pids"]     = []
+    worker_pool["last_check"] = datetime.now().isoformat()
+    return executor
+
+def acquire_pool():
+    if worker_pool["executor"] is None:
+        start_pool()
+    with _pool_lock:
+        executor = check_pool()
+        worker_pool["active_jobs"] += 1
+    return executor
+
+def count_tasks(n):
+    with _pool_lock:
+        worker_pool["tasks"] += n
+
+def release_pool():
+    with _pool_lock:
+        worker_pool["active_jobs"] -= 1
+
+# Chunked scheduling. run_tasks sorts the tasks longest-expected-first (by cost, if given) and submits them in
+# chunks that shrink as the queue drains: each chunk takes the remaining tasks over CHUNK_FACTOR * WORKERS, but never
+# more than CHUNK_MAX. The long tasks start first, each submission carries several tasks while the queue is long, and
+# the tail is single tasks that whichever worker is free picks up. Results are yielded through as_completed as each
+# chunk finishes, with their index in tasks; a chunk's results come back together, so CHUNK_MAX bounds how many tasks
+# a worker runs before progress moves, and one slow task holds up nothing else.
+# Once cancelled() is true, run_tasks drops the chunks that have not started, waits for the running ones (which see
+# the job's cancel marker and stop after their current task, or the GA after its current round) and raises
+# JobCancelled, so the workers are free for the next job by the time it returns.
+CHUNK_FACTOR = 4
+CHUNK_MAX    = 8
 
-    rider_data = {rid: info(rid) for rid in rider_ids}
-    W_rem      = [rider_data[r]["W_prime"] for r in rider_ids]
+class JobCancelled(Exception):
+    pass
+
+def expected_cost(task):
+    accel_len, peel, order, changes = task
+    # schedules with this many switch points after the acceleration; the joint search tries them for every peel
+    return math.comb(31 - accel_len, changes) * (23 if peel is None else 1)
+
+def run_chunk(func, ref, chunk):
+    results = []
+    for task in chunk:
+        results.append(in_context(func, ref, task))
+        if cancel_requested():
+            break
+    return results
+
+def run_tasks(pool, func, ref, tasks, cost=None, cancelled=None, count=True):
+    queue = sorted(range(len(tasks)), key=lambda k: -cost(tasks[k])) if cost else list(range(len(tasks)))
+    futures = {}
+    while queue:
+        size = min(CHUNK_MAX, max(1, len(queue) // (CHUNK_FACTOR * WORKERS)))
+        chunk, queue = queue[:size], queue[size:]
+        futures[pool.submit(run_chunk, func, ref, [tasks[k] for k in chunk])] = chunk
+    collected = set()
+    try:
+        for future in as_completed(futures):
+            collected.add(future)
+            results = future.result()
+            if count:
+                count_tasks(len(results))
+            if cancelled is not None and cancelled():
+                raise JobCancelled()
+            yield from zip(futures[future], results)
+    finally:
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        # chunks that were already running when the job stopped still ran on a worker; dropped ones did not
+        for future in futures:
+            if count and future not in collected and not future.cancelled() and future.exception() is None:
+                count_tasks(len(future.result()))
+
+def task_inputs(task, state=None):
+    state = state or _worker
+    accel_len, peel, order, changes = task
+    order = tuple(r-1 for r in order)
+    # the optimizers only read rider_data, so no DataFrame is passed on
+    return accel_len, peel, order, changes, None, state["drag_adv"], state["rider_data"], state["W_rem"]
+
+# Random stream of one task: the request's seed, spawned by the task's own parameters rather than its position in
+# the grid, so every task gets an independent stream that does not shift when the pre-screen drops other tasks.
+def task_seed(task, state=None):
+    state = state or _worker
+    accel_len, peel, order, changes = task
+    return np.random.SeedSequence(state.get("seed") or 0, spawn_key=(accel_len, peel or 0, *order, changes))
+
+def bound_one(task):
+    accel_len, peel, order, changes, df, drag_adv, rider_data, W_rem = task_inputs(task)
+    try:
+        return race_time_bounds(peel if peel is not None else range(10, 33), list(order), accel_len, changes, drag_adv, df, rider_data, W_rem)
+    except Exception:
+        # never skip a task that could not be bounded
+        return float("-inf"), float("inf")
+
+def screen_one(args):
+    task, cutoff = args
+    accel_len, peel, order, changes, df, drag_adv, rider_data, W_rem = task_inputs(task)
+    try:
+        return can_beat(cutoff, peel if peel is not None else range(10, 33), list(order), accel_len, changes, drag_adv, df, rider_data, W_rem)
+    except Exception:
+        return True
+
+def add_search_stats(total, stats):
+    for key, value in stats.items():
+        if key == "stopped_by":
+            total.setdefault("stopped_by", {})
+            total["stopped_by"][value] = total["stopped_by"].get(value, 0) + 1
+        else:
+            total[key] = total.get(key, 0) + value
+
+# state is the worker context, for a task run outside the pool (the island search, whose islands use the pool)
+def simulate_one(task, pool=None, state=None):
+    ctx = state or _worker
+    accel_len, peel, order, changes, df, drag_adv, rider_data, W_rem = task_inputs(task, ctx)
+    rider_ids = [int(rid) for rid in ctx["riders"]["id"]]
 
     # Quick debug log
     print(f"[simulate_one] rider_ids={rider_ids}, order={order}, W_rem={W_rem}")
 
     try:
-        time_race, switch_tuple, _ = genetic_algorithm(
+        if ctx.get("search") == "exhaustive":
+            # guaranteed best schedule for this (peel, order, acc_length), found by branch-and-bound
+            time_race, switch_tuple, _, stats = exhaustive_search(
+                peel               = peel,
+                initial_order      = list(order),
+                acceleration_length= accel_len,
+                num_changes        = changes,
+                drag_adv           = drag_adv,
+                df                 = df,
+                rider_data         = rider_data,
+                W_rem              = W_rem,
+                return_stats       = True,
+            )
+            logger.debug("simulate_one: exhaustive search %s", stats)
+            return {
+                "success": True,
+                "result": ((switch_tuple, "initial order:", *order, "peel location:", peel), time_race),
+                "races": stats["leaves_evaluated"],
+                "stats": stats,
+            }
+
+        if ctx.get("search") == "dp":
+            # DP over turn lengths at each trial velocity; only the schedules feasible at the limit are raced
+            time_race, switch_tuple, _, stats = dp_optimizer(
+                peel               = peel,
+                initial_order      = list(order),
+                acceleration_length= accel_len,
+                num_changes        = changes,
+                drag_adv           = drag_adv,
+                df                 = df,
+                rider_data         = rider_data,
+                W_rem              = W_rem,
+                return_stats       = True,
+            )
+            logger.debug("simulate_one: dp search %s", stats)
+            return {
+                "success": True,
+                "result": ((switch_tuple, "initial order:", *order, "peel location:", peel), time_race),
+                "races": stats["candidates"],
+                "stats": stats,
+            }
+
+        if ctx.get("search") == "joint":
+            # peel is a gene: one GA over every peel from 10 to 32, sharing the fitness cache
+            time_race, (peel, switch_tuple), _, stats = joint_genetic_algorithm(
+                initial_order      = list(order),
+                acceleration_length= accel_len,
+                num_changes        = changes,
+                drag_adv           = drag_adv,
+                df                 = df,
+                rider_data         = rider_data,
+                W_rem              = W_rem,
+                peels              = range(10, 33),
+                rng                = task_seed(task, ctx),
+                return_stats       = True,
+                should_stop        = lambda: cancel_requested(ctx),
+            )
+            logger.debug("simulate_one: joint search %s", stats)
+            return {
+                "success": True,
+                "result": ((switch_tuple, "initial order:", *order, "peel location:", peel), time_race),
+                "races": stats["evaluations"],
+                "stats": stats,
+            }
+
+        if ctx.get("search") == "island":
+            # island-model GA; the tasks run one at a time and the pool spreads each task's NUM_ISLANDS islands over
+            # its workers. The islands evolve in parallel and swap their best schedules every 2 rounds.
+            time_race, switch_tuple, _, stats = island_genetic_algorithm(
+                peel               = peel,
+                initial_order      = list(order),
+                acceleration_length= accel_len,
+                num_changes        = changes,
+                drag_adv           = drag_adv,
+                df                 = df,
+                rider_data         = rider_data,
+                W_rem              = W_rem,
+                num_islands        = NUM_ISLANDS,
+                num_rounds         = 5,
+                rng                = task_seed(task, ctx),
+                executor           = pool,
+                should_stop        = lambda: cancel_requested(ctx),
+                return_stats       = True,
+            )
+            return {
+                "success": True,
+                "result": ((switch_tuple, "initial order:", *order, "peel location:", peel), time_race),
+                "races": stats["evaluations"],
+                "stats": stats,
+            }
+
+        if ctx.get("promote") is not None:
+            # coarse model for every child, full combined model for the best share of each generation
+            batch_func = functools.partial(multi_fidelity_batch, promote=ctx["promote"])
+        else:
+            # each generation is timed in one vectorized pass over this leader's inverse acceleration curve
+            batch_func = black_box_batch
+        fidelity_before = dict(multi_fidelity_stats)
+
+        time_race, switch_tuple, _, stats = genetic_algorithm(
             peel               = peel,
             initial_order      = list(order),
             acceleration_length= accel_len,
@@ -126,7 +526,17 @@ def simulate_one(args):
             num_children       = 10,
             num_seeds          = 4,
             num_rounds         = 5,
+            batch_func         = batch_func,
+            # vectorized child sampling on the task's own stream, so a rerun gives the same schedule
+            rng                = task_seed(task, ctx),
+            # stop early once two rounds in a row bring no improvement
+            patience           = 2,
+            return_stats       = True,
+            surrogate          = True if ctx.get("surrogate") else None,
+            # a cancelled job stops its GAs between rounds
+            should_stop        = lambda: cancel_requested(ctx),
         )
+        logger.debug("simulate_one: genetic algorithm %s", stats)
 
         schedule_descr = (
             switch_tuple,
@@ -137,7 +547,10 @@ def simulate_one(args):
         return {
             "success": True,
             "result": (schedule_descr, time_race),
-            "races": 50,   # one GA call covers 50 inner simulations
+            "races": stats["evaluations"],
+            "stats": stats,
+            "races_skipped": stats.get("surrogate_skipped", 0),
+            "fidelity": {key: multi_fidelity_stats[key] - fidelity_before[key] for key in multi_fidelity_stats},
         }
 
     except Exception as e:
@@ -155,16 +568,55 @@ def shutdown_vm(project_id, zone, instance_name):
 def trigger_shutdown():
     print("🕒 Waiting 15 seconds before shutdown...")
     time.sleep(15)
+    if job_queue or running_jobs:
+        print("Jobs arrived, shutdown cancelled.")
+        return
     shutdown_vm("team-pursuit-optimizer", "us-central1-f", "optimization-backend")
 
+# Job queue. Submitted jobs wait in job_queue (at most MAX_QUEUED_JOBS; more are rejected with 503) and
+# dispatch_jobs starts them in order on their own threads while fewer than MAX_RUNNING_JOBS are running, so
+# concurrent submissions share the worker pool instead of oversubscribing the cores. When a job ends the next one
+# starts; once a job succeeds with nothing left running or queued, the VM is shut down as before.
+job_queue: deque[str] = deque()
+running_jobs: set[str] = set()
+cancelled_jobs: set[str] = set()
+_queue_lock = threading.Lock()
+
+def dispatch_jobs():
+    with _queue_lock:
+        while job_queue and len(running_jobs) < MAX_RUNNING_JOBS:
+            job_id = job_queue.popleft()
+            running_jobs.add(job_id)
+            jobs[job_id]["state"] = "running"
+            Thread(target=run_queued_job, args=(job_id,), daemon=True).start()
+
+def run_queued_job(job_id: str):
+    try:
+        run_opt_job(job_id)
+    finally:
+        with _queue_lock:
+            running_jobs.discard(job_id)
+            cancelled_jobs.discard(job_id)
+            idle = not job_queue and not running_jobs
+        if os.path.exists(cancel_marker(job_id)):
+            os.remove(cancel_marker(job_id))
+        dispatch_jobs()
+    # Optional shutdown
+    if idle and jobs[job_id]["state"] == "done":
+        Thread(target=trigger_shutdown, daemon=True).start()
+
+def queue_position(job_id: str):
+    with _queue_lock:
+        return job_queue.index(job_id) + 1 if job_id in job_queue else None
+
 @app.post("/run_optimization")
-def run_optimization(req: OptRequest, background: BackgroundTasks):
+def run_optimization(req: OptRequest):
     if len(req.rider_ids) != 4:
         raise HTTPException(422, detail=f"Exactly 4 rider_ids required (got {len(req.rider_ids)})")
     if len(req.drag_adv) != 4:
         raise HTTPException(422, detail=f"drag_adv must have 4 entries (got {len(req.drag_adv)})")
     job_id = str(uuid.uuid4())
-    jobs[job_id] = {
+    job = {
         "state": "queued",
         "ctx": {
             "df": pd.read_json(req.workbook, orient="split"),
@@ -173,15 +625,51 @@ def run_optimization(req: OptRequest, background: BackgroundTasks):
             "rho": req.rho,
             "Crr": req.Crr,
             "v0": req.v0,
+            "search": req.search,
+            "promote": req.promote,
+            "surrogate": req.surrogate,
+            "seed": req.seed,
         },
     }
-    background.add_task(run_opt_job, job_id)
-    return {"job_id": job_id}
+    with _queue_lock:
+        if len(job_queue) >= MAX_QUEUED_JOBS:
+            raise HTTPException(503, detail=f"Job queue is full ({MAX_QUEUED_JOBS} waiting), try again later",
+                                headers={"Retry-After": "60"})
+        jobs[job_id] = job
+        job_queue.append(job_id)
+    dispatch_jobs()
+    # None once the job has started
+    return {"job_id": job_id, "position": queue_position(job_id)}
+
+@app.delete("/run_optimization/{job_id}")
+def cancel_optimization(job_id: str):
+    """Cancel a queued job, or stop a running one; its workers go to the next queued job."""
+    if job_id not in jobs:
+        return {"error": "job_id not found"}
+    with _queue_lock:
+        if job_id in job_queue:
+            job_queue.remove(job_id)
+            jobs[job_id] = {"state": "cancelled"}
+        elif job_id in running_jobs:
+            cancelled_jobs.add(job_id)
+            open(cancel_marker(job_id), "w").close()
+    return {"job_id": job_id, "state": optimisation_status(job_id)["state"]}
+
+@app.get("/workers")
+def worker_status():
+    """State of the shared worker pool."""
+    return {"workers": WORKERS, "max_tasks_per_worker": WORKER_MAX_TASKS,
+            **{key: value for key, value in worker_pool.items() if key != "executor"}}
 
 @app.get("/run_optimization/{job_id}")
 def optimisation_status(job_id: str):
     """Return current state / progress or 404 if unknown."""
     if job_id not in jobs:
         return {"error": "job_id not found"}
-    return jobs[job_id]
+    status = {key: value for key, value in jobs[job_id].items() if key != "ctx"}
+    if status["state"] == "queued":
+        status.update(position=queue_position(job_id), queue_length=len(job_queue))
+    elif status["state"] == "running" and job_id in cancelled_jobs:
+        status["state"] = "cancelling"
+    return status
 